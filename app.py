@@ -1,17 +1,47 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, url_for, abort, g, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
 import json
-import traceback
+import os
 import base64
-from PIL import Image
-from io import BytesIO
-import random
+import csv
+import heapq
+import io
+import secrets
 import string
+import time
 from datetime import datetime, timedelta
-import sqlite3
+import applog
+import auth
+import cache
+import compression
+import db
+import events
+import geo
+import groupcommit
+from auth import store_token_required
+from db import get_db, dict_factory
+import images
+import maintenance
+import metrics
+import migrations
+import repository
+import search
+import shards
+import sync
+
+logger = applog.setup_logging()
+if not os.environ.get('SECRET_KEY'):
+    logger.warning("SECRET_KEY is not set, store tokens will not survive a restart")
 
 app = Flask(__name__)
+# Reverse proxies in front of the app whose X-Forwarded-* headers are
+# trusted; 0 uses the peer address. gunicorn.conf.py sets 1 for the
+# Procfile's router. Login rate limits are keyed on the client address
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
 CORS(app, resources={
     r"/*": {
         "origins": "*",
@@ -19,9 +49,12 @@ CORS(app, resources={
         "allow_headers": ["Content-Type", "Authorization"]
     }
 })
+metrics.init_app(app)
+# Registered after metrics so the recorded response size is the compressed one
+compression.init_app(app)
 
-def generate_random_code(length=2):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+def generate_random_code(length=10):
+    return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(length))
 
 
 @app.route('/test', methods=['GET'])
@@ -29,108 +62,40 @@ def test_connection():
     return jsonify({"status": "ok", "message": "Server is running"})
 
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format, summed over all workers when METRICS_DIR is set
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-def init_db():
-    print("Initializing database")
-
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
 
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS stores (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            address TEXT NOT NULL,
-            phone_number INTEGER DEFAULT NULL,
-            activity TEXT NOT NULL,
-            code TEXT NOT NULL,
-            plan TEXT DEFAULT 'free' CHECK (plan IN ('free', 'pro')),
-            plan_updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+def init_db():
+    logger.info("Initializing database")
+    repository.check_database_url()
 
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS clients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            store_id INTEGER NOT NULL,
-            name VARCHAR(100) NOT NULL,
-            phone_number VARCHAR(20),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE
-        )
-    ''')
-    # Create products table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            store_id INTEGER NOT NULL,
-            name VARCHAR(100) NOT NULL,
-            description TEXT,
-            price FLOAT NOT NULL,
-            category VARCHAR(50),
-            new INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE
-        )
-    ''')
-    
-    # Create separate images table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS product_images (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER NOT NULL,
-            image_data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE
-        )
-    ''')
-    
-    # Create orders table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            store_id INTEGER NOT NULL,
-            client_id INTEGER,
-            name VARCHAR(100) DEFAULT 'aucun',
-            phone_number VARCHAR(20) DEFAULT 'N/A',
-            latitude FLOAT,
-            longitude FLOAT,
-            total FLOAT NOT NULL,
-            products TEXT NOT NULL,
-            status VARCHAR(20) DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            delivered BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE,
-            FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE SET NULL
-        )
-    ''')
-    
-    conn.commit()
+    conn = db.connect()
+    # Migrations can take a while on a large file, wait for other workers instead of failing
+    conn.execute('PRAGMA busy_timeout = 60000')
+    conn.execute('PRAGMA journal_mode = WAL')
+    applied = migrations.migrate(conn)
+    conn.execute('PRAGMA optimize')
     conn.close()
-    print("Database initialized successfully")
+    shards.init_shards()
+    cache.init_shared_cache()
+    logger.info("Database initialized successfully", extra={'migrations_applied': applied})
 
 
 @app.route('/stores', methods=['POST'])
 def new_store():
     
     try:
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
         data = request.get_json()
-        print("Parsed store data:", data)
+        logger.debug("Parsed store data", extra={'payload': data})
 
         required_fields = ['name', 'address', 'phone_number', 'activity']
         for field in required_fields:
             if field not in data:
                 error_msg = f"Missing required field: {field}"
-                print(error_msg)
+                logger.info(error_msg)
                 return jsonify({"error": error_msg}), 400
             
         name = data['name']
@@ -140,18 +105,14 @@ def new_store():
 
         code = generate_random_code()
 
-        c.execute('''
-            INSERT INTO stores (name, address, phone_number, activity, code)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (name, address, phone_number, activity, code))
+        with repository.transaction() as conn:
+            repository.create_store(conn, name, address, phone_number, activity, code)
         
-        conn.commit()
-        conn.close()
         return jsonify({"message": "Store added successfully", "code": code}), 201
         
-    except Exception as e:
-        print(f"Error adding store: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    except Exception:
+        logger.exception("Error adding store")
+        return jsonify({"error": "An error occurred while adding the store"}), 500
     
 
 @app.route('/store/login', methods=['GET'])
@@ -162,58 +123,316 @@ def get_store_by_login():
 
         if not code or not store_id:
             return jsonify({"message": "Missing code or store_id"}), 400
+        try:
+            store_id = int(store_id)
+        except ValueError:
+            return jsonify({"message": "Invalid store_id"}), 400
 
-        print(f"Code: {code}, Store ID: {store_id}")
+        # Codes are short enough to guess, so attempts are limited per
+        # client address and failures per store
+        retry_after = max(auth.login_attempts.retry_after(request.remote_addr),
+                          auth.login_failures.retry_after(store_id))
+        if retry_after:
+            logger.warning("Store login rate limited", extra={'store_id': store_id})
+            response = jsonify({"success": False, "message": "Too many login attempts"})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+        auth.login_attempts.hit(request.remote_addr)
 
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
+        logger.debug("Store login", extra={'store_id': store_id})
 
-        c.execute("SELECT * FROM stores WHERE code = ? AND id = ?", (code, store_id))
-        store = c.fetchone()
+        with repository.transaction() as conn:
+            store = repository.get_store(conn, store_id)
 
-        conn.close()
+        column_names = ['id', 'name', 'address', 'phone_number', 'activity', 'code', 'plan', 'plan_updated_at', 'created_at']
+        store_data = {name: store[name] for name in column_names} if store else None
 
-        if store:
-            column_names = ['id', 'name', 'address', 'phone_number', 'activity', 'code', 'plan', 'plan_updated_at', 'created_at']
-            store_data = dict(zip(column_names, store))
-            return jsonify({"success": True, "message": "Store found", "store": store_data}), 200
+        # Constant-time comparison so response timing does not leak the code
+        if store_data and secrets.compare_digest(store_data['code'].encode(), code.encode()):
+            return jsonify({
+                "success": True,
+                "message": "Store found",
+                "store": store_data,
+                "token": auth.issue_token(store_data['id']),
+                "expires_in": auth.TOKEN_MAX_AGE
+            }), 200
 
+        auth.login_failures.hit(store_id)
         return jsonify({"success": False, "message": "Store not found"}), 404
 
-    except Exception as e:
-        print(f"Error fetching store: {str(e)}")
-        return jsonify({"error": "An error occurred while fetching the store", "details": str(e)}), 500
+    except Exception:
+        logger.exception("Error fetching store")
+        return jsonify({"error": "An error occurred while fetching the store"}), 500
 
-    except Exception as e:
-        print(f"Error fetching store: {str(e)}")
-        return jsonify({"error": "An error occurred while fetching the store", "details": str(e)}), 500
+ORDER_FIELDS = [
+    'id', 'store_id', 'client_id', 'name', 'phone_number', 'latitude', 'longitude',
+    'total', 'products', 'status', 'created_at', 'delivered'
+]
+STORE_ORDER_FIELDS = [
+    'id', 'name', 'phone_number', 'latitude', 'longitude',
+    'total', 'products', 'created_at', 'delivered'
+]
+MAX_PAGE_SIZE = 500
+ORDER_ITEMS_BATCH_SIZE = 500
+
+def order_columns(fields):
+    """The orders columns behind ``fields``; products come from order_items."""
+    return [field for field in fields if field != 'products']
+
+def load_order_items(conn, order_ids):
+    """Line items for many orders at once, as ``{order_id: JSON text of the list}``.
+
+    The items are the objects the client sent, in the same order.
+    """
+    items = dict.fromkeys(order_ids, '[]')
+    order_ids = list(items)
+    for start in range(0, len(order_ids), ORDER_ITEMS_BATCH_SIZE):
+        batch = order_ids[start:start + ORDER_ITEMS_BATCH_SIZE]
+        c = conn.cursor()
+        c.row_factory = None
+        c.execute(f'''
+            SELECT order_id, json_group_array(json(item)) FROM (
+                SELECT order_id, item FROM order_items
+                WHERE order_id IN ({', '.join('?' * len(batch))})
+                ORDER BY order_id, id
+            )
+            GROUP BY order_id
+        ''', batch)
+        items.update(c.fetchall())
+    return items
+
+def encode_cursor(order):
+    raw = json.dumps([order['created_at'], order['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(created_at), int(order_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_bool_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f"Invalid {name} value: {value}")
+
+def order_filters(store_id=None):
+    """WHERE clause and params for the order listing filters in the query string."""
+    conditions = []
+    params = []
+    if store_id is not None:
+        conditions.append('store_id = ?')
+        params.append(store_id)
+
+    delivered = parse_bool_arg('delivered')
+    if delivered is not None:
+        conditions.append('delivered = ?')
+        params.append(delivered)
+
+    status = request.args.get('status')
+    if status:
+        conditions.append('status = ?')
+        params.append(status)
+
+    range_from = parse_datetime_arg('from')
+    if range_from:
+        conditions.append('created_at >= ?')
+        params.append(range_from.strftime('%Y-%m-%d %H:%M:%S'))
+    range_to = parse_datetime_arg('to')
+    if range_to:
+        conditions.append('created_at < ?')
+        params.append(range_to.strftime('%Y-%m-%d %H:%M:%S'))
+
+    return conditions, params
+
+def list_orders(store_id=None, default_fields=ORDER_FIELDS):
+    """Order listing shared by /orders and /orders/<storeId>.
+
+    Without ``limit`` or ``cursor`` the whole (filtered) list is returned as
+    before. With them, results come in pages of ``limit`` rows, newest
+    first, keyed on (created_at, id) so deep pages cost the same as the
+    first, and the response is ``{"orders": [...], "next_cursor": ...}``.
+    ``fields`` restricts the returned columns; leaving out ``products``
+    also skips loading the line items.
+    """
+    fields = default_fields
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in default_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    paginate = 'limit' in request.args or 'cursor' in request.args
+    limit = None
+    if paginate:
+        limit = request.args.get('limit', '50')
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError("limit must be a positive integer")
+        limit = min(int(limit), MAX_PAGE_SIZE)
+
+    conditions, params = order_filters(store_id)
+    if request.args.get('cursor'):
+        conditions.append('(created_at, id) < (?, ?)')
+        params.extend(decode_cursor(request.args['cursor']))
+
+    # Line items are looked up by id; the cursor, and the merge across
+    # shards, need the sort key even when the caller did not ask for it
+    with_products = 'products' in fields
+    columns = order_columns(fields)
+    needed = []
+    if with_products:
+        needed.append('id')
+    if paginate or store_id is None:
+        needed += ['id', 'created_at']
+    extra_columns = [field for field in dict.fromkeys(needed) if field not in columns]
+    columns += extra_columns
+
+    query = f"SELECT {', '.join(columns)} FROM orders"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY created_at DESC, id DESC'
+    if limit:
+        # One extra row tells us whether there is a next page
+        query += ' LIMIT ?'
+        params.append(limit + 1)
+
+    def read(path):
+        with get_db(dict_factory, path) as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            orders = c.fetchall()
+            if with_products:
+                items = load_order_items(conn, [order['id'] for order in orders])
+                for order in orders:
+                    order['products'] = json.loads(items[order['id']])
+        return orders
+
+    if store_id is not None:
+        orders = read(shards.orders_path(store_id))
+    else:
+        # Each shard returns its own first page, sorted; the merge keeps the best of them
+        orders = list(heapq.merge(
+            *shards.scatter(read), key=lambda order: (order['created_at'] or '', order['id']), reverse=True
+        ))
+
+    next_cursor = None
+    if limit and len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1])
+
+    for order in orders:
+        for column in extra_columns:
+            del order[column]
+
+    if paginate:
+        return jsonify({"orders": orders, "next_cursor": next_cursor})
+    return jsonify(orders)
 
 @app.route('/orders', methods=['GET'])
+@store_token_required()
 def get_orders():
     try:
-        conn = sqlite3.connect('orders.db')
-        conn.row_factory = dict_factory
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT * FROM orders 
-            ORDER BY created_at DESC
-        ''')
-        
-        orders = c.fetchall()
-        conn.close()
-        
-        # تحويل المنتجات من JSON string إلى كائن
-        for order in orders:
-            order['products'] = json.loads(order['products'])
-        
-        return jsonify(orders)
-        
+        # A store token only ever lists its own store's orders
+        return list_orders(g.store_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print("Error fetching orders:", str(e))
+        logger.exception("Error fetching orders")
         return jsonify({"error": str(e)}), 500
 
+EXPORT_BATCH_SIZE = 500
+
+@app.route('/orders/export', methods=['GET'])
+@store_token_required()
+def export_orders():
+    """Stream orders as NDJSON (default) or CSV, oldest first.
+
+    Rows are read with fetchmany and written as they come, so memory use
+    does not depend on the number of orders. Accepts the listing filters
+    plus ``store_id`` and ``since_id``; pass the last exported id as
+    ``since_id`` to pull only newer orders. Only the orders of the token's
+    store are exported.
+    """
+    try:
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return jsonify({"error": "format must be 'ndjson' or 'csv'"}), 400
+
+        store_id = request.args.get('store_id')
+        if g.store_id is not None:
+            if store_id and store_id != str(g.store_id):
+                return jsonify({"error": "Token does not grant access to this store"}), 403
+            store_id = str(g.store_id)
+        conditions, params = order_filters(store_id)
+        since_id = request.args.get('since_id')
+        if since_id:
+            if not since_id.isdigit():
+                return jsonify({"error": "since_id must be an integer"}), 400
+            # Ids only grow within a shard
+            if shards.SHARD_COUNT and not store_id:
+                return jsonify({"error": "since_id needs store_id when orders are sharded"}), 400
+            conditions.append('id > ?')
+            params.append(int(since_id))
+        # One shard after the other, each oldest first
+        paths = [shards.orders_path(store_id)] if store_id else shards.orders_paths()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    columns = order_columns(ORDER_FIELDS)
+    query = f"SELECT {', '.join(columns)} FROM orders"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY id'
+
+    def generate():
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(ORDER_FIELDS)
+
+        for path in paths:
+            with get_db(path=path) as conn:
+                c = conn.cursor()
+                c.execute(query, params)
+
+                while True:
+                    rows = c.fetchmany(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+
+                    orders = [dict(zip(columns, row)) for row in rows]
+                    items = load_order_items(conn, [order['id'] for order in orders])
+
+                    if export_format == 'csv':
+                        for order in orders:
+                            order['products'] = items[order['id']]
+                            writer.writerow([order[field] for field in ORDER_FIELDS])
+                        chunk = buffer.getvalue()
+                        buffer.seek(0)
+                        buffer.truncate()
+                        yield chunk
+                        continue
+
+                    # The items are already JSON text, splice them in instead of decoding them
+                    lines = []
+                    for order in orders:
+                        lines.append(json.dumps(order)[:-1] + ', "products": ' + items[order['id']] + '}\n')
+                    yield ''.join(lines)
+
+    if export_format == 'csv':
+        response = app.response_class(stream_with_context(generate()), mimetype='text/csv')
+        response.headers['Content-Disposition'] = 'attachment; filename=orders.csv'
+        return response
+    return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/products/<int:storeId>', methods=['POST', 'GET'])
+@store_token_required('POST')
 def manage_products(storeId):
 
     
@@ -225,214 +444,795 @@ def manage_products(storeId):
             category = request.form.get('category')
             is_new = request.form.get('new', '0')
             image = request.files.get('image')
+            image_bytes = image.read() if image else None
+
+            if image_bytes and not images.is_image(image_bytes):
+                return jsonify({"error": "Unsupported image format"}), 400
+
+            if image_bytes and not images.reserve_upload():
+                response = jsonify({"error": "Image processing is busy, try again shortly"})
+                response.headers['Retry-After'] = str(images.IMAGE_RETRY_AFTER)
+                return response, 503
             
-            conn = sqlite3.connect('orders.db')
-            c = conn.cursor()
-            
-            # Insert product with storeId
-            c.execute('''
-                INSERT INTO products (name, price, description, category, new, store_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (name, price, description, category, is_new, storeId))
-            
-            product_id = c.lastrowid  # Get the ID of the newly inserted product
-            
-            # If image was provided, process and save it
-            if image:
-                image_bytes = image.read()
-                compressed_image = compress_image(image_bytes)
-                image_data = base64.b64encode(compressed_image).decode('utf-8')
-                
-                c.execute('''
-                    INSERT INTO product_images (product_id, image_data)
-                    VALUES (?, ?)
-                ''', (product_id, image_data))
-            
-            conn.commit()
-            conn.close()
-            return jsonify({"message": "Product added successfully"}), 201
+            try:
+                with get_db() as conn:
+                    c = conn.cursor()
+                    
+                    # Insert product with storeId
+                    c.execute('''
+                        INSERT INTO products (name, price, description, category, new, store_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (name, price, description, category, is_new, storeId))
+                    
+                    product_id = c.lastrowid  # Get the ID of the newly inserted product
+            except Exception:
+                if image_bytes:
+                    images.release_upload()
+                raise
+
+            # The image is resized in the background and attached when ready
+            if image_bytes:
+                try:
+                    images.submit_upload(
+                        image_bytes,
+                        lambda image_sha, renditions: attach_product_image(product_id, image_sha, renditions)
+                    )
+                except Exception:
+                    # The request fails, so the product must not stay behind
+                    # for a retry to duplicate
+                    with get_db() as conn:
+                        conn.execute('DELETE FROM products WHERE id = ?', (product_id,))
+                    raise
+
+            return jsonify({
+                "message": "Product added successfully",
+                "product_id": product_id,
+                "image_pending": bool(image_bytes)
+            }), 201
             
         except Exception as e:
-            print(f"Error adding product: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception("Error adding product")
             return jsonify({"error": str(e)}), 500
     
     elif request.method == 'GET':
         try:
-            conn = sqlite3.connect('orders.db')
-            conn.row_factory = dict_factory
-            c = conn.cursor()
-            
-            # Get products filtered by storeId
-            c.execute('''
-                SELECT p.*, pi.image_data
-                FROM products p
-                LEFT JOIN product_images pi ON p.id = pi.product_id
-                WHERE p.store_id = ?
-                ORDER BY p.created_at DESC
-            ''', (storeId,))
-            products = c.fetchall()
-            conn.close()
-            
-            # Process images for each product
-            for product in products:
-                if 'image_data' in product and product['image_data']:
-                    product['image'] = product['image_data']
-                del product['image_data']  # Remove raw image data from response
-                
-            return jsonify(products)
+            with get_db(dict_factory) as conn:
+                # The version changes with every product or image write, which
+                # is what invalidates the cached catalogue
+                version = cache.catalogue_version(conn, storeId)
+                etag, body = cache.get_catalogue(storeId, version, lambda: build_catalogue(conn, storeId))
+
+            # compression.py answers If-None-Match and keeps the compressed
+            # body cached under this ETag
+            response = app.response_class(body, mimetype='application/json')
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
         except Exception as e:
-            print(f"Error fetching products: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception("Error fetching products")
             return jsonify({"error": str(e)}), 500
 
+def build_catalogue(conn, storeId):
+    c = conn.cursor()
+    
+    # Get products filtered by storeId
+    c.execute('''
+        SELECT p.*, pi.image_hash
+        FROM products p
+        LEFT JOIN product_images pi ON p.id = pi.product_id
+        WHERE p.store_id = ?
+        ORDER BY p.created_at DESC
+    ''', (storeId,))
+    products = c.fetchall()
+    
+    # Images are fetched separately so the listing stays small
+    for product in products:
+        # Internal to /products/<storeId>/sync
+        product.pop('sync_seq')
+        image_sha = product.pop('image_hash')
+        if image_sha:
+            product['image_url'] = url_for('get_image', image_sha=image_sha, ext='jpg')
+        
+    return jsonify(products).get_data()
+
+def parse_sync_args(kind):
+    """``(since, limit)`` from the query string of a /sync route."""
+    since = request.args.get('since')
+    if since:
+        since = sync.decode_token(kind, since)
+    limit = request.args.get('limit', str(MAX_PAGE_SIZE))
+    if not limit.isdigit() or int(limit) < 1:
+        raise ValueError("limit must be a positive integer")
+    return since or None, min(int(limit), MAX_PAGE_SIZE)
+
+@app.route('/products/<int:storeId>/sync', methods=['GET'])
+def sync_products(storeId):
+    """Products written or deleted since the client's last sync.
+
+    Pass the ``sync_token`` of the previous response as ``since``; without
+    one, or when it is too old, the response has ``reset`` set and lists
+    the whole catalogue, which replaces the client's copy. Changes come
+    oldest first in pages of ``limit``; ``has_more`` asks for another call
+    with the new token.
+    """
+    try:
+        try:
+            since, limit = parse_sync_args('product')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        with get_db() as conn:
+            updated, deleted, position, has_more, reset = sync.changes(conn, storeId, 'product', since, limit)
+            products = {}
+            if updated:
+                c = conn.cursor()
+                c.row_factory = dict_factory
+                c.execute(f'''
+                    SELECT p.*,
+                           (SELECT image_hash FROM product_images WHERE product_id = p.id ORDER BY id DESC LIMIT 1)
+                               AS image_hash
+                    FROM products p WHERE p.id IN ({', '.join('?' * len(updated))})
+                ''', updated)
+                products = {product['id']: product for product in c.fetchall()}
+
+        for product in products.values():
+            product.pop('sync_seq')
+            image_sha = product.pop('image_hash')
+            if image_sha:
+                product['image_url'] = url_for('get_image', image_sha=image_sha, ext='jpg')
+
+        return jsonify({
+            "products": [products[product_id] for product_id in updated],
+            "deleted": deleted,
+            "reset": reset,
+            "has_more": has_more,
+            "sync_token": sync.encode_token('product', position)
+        }), 200
+    except Exception as e:
+        logger.exception("Error syncing products")
+        return jsonify({"error": str(e)}), 500
+
+MAX_SEARCH_PAGE_SIZE = 100
+
+@app.route('/products/<int:storeId>/search', methods=['GET'])
+def search_products(storeId):
+    """Search a store's catalogue without downloading all of it.
+
+    ``q`` matches word prefixes in names and descriptions, best matches
+    first; ``category`` and ``new`` filter the results. ``facets`` holds
+    the match count per category, before the category filter. Pages come
+    from ``limit`` and ``offset``.
+    """
+    try:
+        limit = request.args.get('limit', '20')
+        offset = request.args.get('offset', '0')
+        if not limit.isdigit() or int(limit) < 1:
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        if not offset.isdigit():
+            return jsonify({"error": "offset must be a non-negative integer"}), 400
+        limit = min(int(limit), MAX_SEARCH_PAGE_SIZE)
+        offset = int(offset)
+
+        try:
+            new = parse_bool_arg('new')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        with get_db() as conn:
+            products, total, facets = search.search_products(
+                conn, storeId,
+                text=request.args.get('q', '').strip(),
+                category=request.args.get('category') or None,
+                new=new, limit=limit, offset=offset,
+            )
+
+        for product in products:
+            image_sha = product.pop('image_hash')
+            if image_sha:
+                product['image_url'] = url_for('get_image', image_sha=image_sha, ext='jpg')
+
+        next_offset = offset + limit if offset + limit < total else None
+        return jsonify({
+            "products": products,
+            "total": total,
+            "facets": {"category": facets},
+            "next_offset": next_offset
+        }), 200
+    except Exception as e:
+        logger.exception("Error searching products")
+        return jsonify({"error": str(e)}), 500
+
+def attach_product_image(product_id, image_sha, renditions):
+    with get_db() as conn:
+        c = conn.cursor()
+        images.save_renditions(c, image_sha, renditions)
+        c.execute('''
+            INSERT INTO product_images (product_id, image_hash)
+            VALUES (?, ?)
+        ''', (product_id, image_sha))
+
+@app.route('/images/<image_sha>.<ext>', methods=['GET'])
+def get_image(image_sha, ext):
+    size = request.args.get('size', images.DEFAULT_RENDITION)
+    if size not in images.RENDITIONS or ext not in images.FORMATS:
+        abort(404)
+
+    etag = f'{image_sha}-{size}-{ext}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        with get_db() as conn:
+            data = images.load_rendition(conn.cursor(), image_sha, size, ext)
+        if data is None:
+            abort(404)
+        response = app.response_class(data, mimetype=images.MIMETYPES[ext])
+
+    # The URL is derived from the content, so it can be cached forever
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/products/<int:product_id>', methods=['DELETE'])
+@store_token_required()
 def delete_product(product_id):
     try:
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
-        
-        # Delete product (will cascade delete related images)
-        c.execute('DELETE FROM products WHERE id=?', (product_id,))
+        with repository.transaction() as conn:
+            # Delete product (will cascade delete related images)
+            deleted = repository.delete_product(conn, product_id, g.store_id)
         
-        if c.rowcount > 0:
-            conn.commit()
-            conn.close()
+        if deleted:
             return jsonify({'message': 'Product deleted successfully'}), 200
         
-        conn.close()
         return jsonify({'error': 'Product not found'}), 404
         
-    except Exception as e:
-        print(f"Error deleting product: {str(e)}")
-        print(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+    except Exception:
+        logger.exception("Error deleting product")
+        return jsonify({"error": "An error occurred while deleting the product"}), 500
+
+INSERT_ORDER_SQL = '''
+    INSERT INTO orders 
+    (name, phone_number, store_id, client_id, latitude, longitude, total, idempotency_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+INSERT_ORDER_ITEMS_SQL = '''
+    INSERT INTO order_items (order_id, store_id, product_id, name, category, qty, unit_price, item)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+MAX_BATCH_ORDERS = 500
+
+def validate_order(data):
+    """Return an error message for an invalid order payload, or None."""
+    if not isinstance(data, dict):
+        return "Order must be an object"
+
+    # التحقق من البيانات المطلوبة
+    required_fields = ['name', 'phoneNumber', 'products', 'store_id', 'client_id', 'total']
+    for field in required_fields:
+        if field not in data:
+            return f"Missing required field: {field}"
+
+    # التحقق من صحة المنتجات
+    if not isinstance(data['products'], list) or not data['products']:
+        return "Products must be a non-empty list"
+    if not all(isinstance(product, dict) for product in data['products']):
+        return "Each product must be an object"
+    # Stored as TEXT and compared with what is stored, so only strings round-trip
+    if data.get('idempotency_key') is not None and not isinstance(data['idempotency_key'], str):
+        return "idempotency_key must be a string"
+    return None
+
+def known_ids(table, ids):
+    """The ids, as text, that exist in ``table`` of the main database.
+
+    Stores and clients stay there when orders are sharded, where foreign
+    keys cannot check them.
+    """
+    ids = {str(row_id) for row_id in ids if row_id is not None}
+    if not ids:
+        return set()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT id FROM {table} WHERE id IN ({', '.join('?' * len(ids))})", list(ids))
+        return {str(row[0]) for row in c.fetchall()}
+
+def order_row(data):
+    return (
+        data['name'],
+        data['phoneNumber'],
+        data['store_id'],
+        data['client_id'],
+        # معالجة الإحداثيات
+        data.get('latitude', 0),
+        data.get('longitude', 0),
+        data['total'],
+        data.get('idempotency_key')
+    )
+
+def order_item_rows(order_id, data):
+    return migrations.order_item_rows(order_id, data['store_id'], data['products'])
 
 @app.route('/orders/<storeId>', methods=['POST', 'GET'])
+@store_token_required('GET')
 def manage_orders(storeId):
-    print(request.get_data())
-    
     if request.method == 'POST':
         try:
-            print("Raw request data:", request.get_data())
             data = request.get_json()
-            print("Parsed order data:", data)
-
-            # التحقق من البيانات المطلوبة
-            required_fields = ['name', 'phoneNumber', 'products', 'store_id', 'client_id', 'total']
-            for field in required_fields:
-                if field not in data:
-                    error_msg = f"Missing required field: {field}"
-                    print(error_msg)
-                    return jsonify({"error": error_msg}), 400
-
-            # التحقق من صحة المنتجات
-            if not isinstance(data['products'], list) or not data['products']:
-                error_msg = "Products must be a non-empty list"
-                print(error_msg)
+            logger.debug("Parsed order data", extra={'payload': data})
+
+            error_msg = validate_order(data)
+            if error_msg:
+                logger.info(error_msg)
                 return jsonify({"error": error_msg}), 400
 
-            # معالجة الإحداثيات
-            latitude = data.get('latitude', 0)
-            longitude = data.get('longitude', 0)
+            if not known_ids('stores', [data['store_id']]):
+                return jsonify({"error": "Store not found"}), 404
+            # An unknown client is dropped, as foreign_key_cleanup did for
+            # existing orders, instead of failing the foreign key
+            if data['client_id'] is not None and not known_ids('clients', [data['client_id']]):
+                data['client_id'] = None
             
-            # تحويل المنتجات إلى JSON string
-            products_json = json.dumps(data['products'])
-            
-            conn = sqlite3.connect('orders.db')
-            c = conn.cursor()
-            
-            # إدخال الطلب
-            c.execute('''
-                INSERT INTO orders 
-                (name, phone_number, store_id, client_id, latitude, longitude, total, products)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                data['name'],
-                data['phoneNumber'],
-                data['store_id'],
-                data['client_id'],
-                latitude,
-                longitude,
-                data['total'],
-                products_json
-            ))
-            
-            order_id = c.lastrowid
-            conn.commit()
-            conn.close()
+            with shards.orders_db(data['store_id'], immediate=True) as conn:
+                c = conn.cursor()
+
+                # A replayed order returns the one already stored
+                if data.get('idempotency_key'):
+                    c.execute(
+                        'SELECT id FROM orders WHERE store_id = ? AND idempotency_key = ?',
+                        (data['store_id'], data['idempotency_key'])
+                    )
+                    existing_order = c.fetchone()
+                    if existing_order:
+                        return jsonify({
+                            "message": "Order already exists",
+                            "order_id": existing_order[0]
+                        }), 200
+                
+                # إدخال الطلب
+                c.execute(INSERT_ORDER_SQL, order_row(data))
+                
+                order_id = c.lastrowid
+                c.executemany(INSERT_ORDER_ITEMS_SQL, order_item_rows(order_id, data))
             
             response_data = {
                 "message": "Order created successfully",
                 "order_id": order_id
             }
-            print("Response data:", response_data)
+            logger.info("Order created", extra={'order_id': order_id, 'store_id': data['store_id']})
+            events.broker_for(shards.orders_path(data['store_id'])).notify()
             return jsonify(response_data), 201
             
         except json.JSONDecodeError as e:
             error_msg = f"Invalid JSON format: {str(e)}"
-            print(error_msg)
+            logger.info(error_msg)
             return jsonify({"error": error_msg}), 400
         except sqlite3.Error as e:
             error_msg = f"Database error: {str(e)}"
-            print(error_msg)
+            logger.exception(error_msg)
             return jsonify({"error": error_msg}), 500
         except Exception as e:
             error_msg = f"Unexpected error: {str(e)}"
-            print(error_msg)
-            print(traceback.format_exc())
+            logger.exception(error_msg)
             return jsonify({"error": error_msg}), 500
     
     elif request.method == 'GET':
         try:
-            conn = sqlite3.connect('orders.db')
-            conn.row_factory = dict_factory
-            c = conn.cursor()
-            
             # استعلام لاسترجاع الطلبات حسب storeId
-            c.execute('''
-                SELECT id, name, phone_number, latitude, longitude, 
-                       total, products, created_at, delivered
-                FROM orders 
-                WHERE store_id = ?
-                ORDER BY created_at DESC
-            ''', (storeId,))
-            
-            orders = c.fetchall()
-            conn.close()
-            
-            # تحويل المنتجات من JSON string إلى كائن
-            for order in orders:
-                order['products'] = json.loads(order['products'])
-            
-            return jsonify(orders)
-            
+            return list_orders(storeId, STORE_ORDER_FIELDS)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
-            print("Error fetching orders:", str(e))
+            logger.exception("Error fetching orders")
             return jsonify({"error": str(e)}), 500
+
+@app.route('/orders/<int:storeId>/sync', methods=['GET'])
+@store_token_required()
+def sync_orders(storeId):
+    """Orders placed, changed or deleted since the store's last sync.
+
+    Works like /products/<storeId>/sync; each order also carries its
+    ``updated_at``.
+    """
+    try:
+        try:
+            since, limit = parse_sync_args('order')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        with shards.orders_db(storeId) as conn:
+            updated, deleted, position, has_more, reset = sync.changes(conn, storeId, 'order', since, limit)
+            orders = {}
+            if updated:
+                c = conn.cursor()
+                c.row_factory = dict_factory
+                c.execute(f'''
+                    SELECT {', '.join(order_columns(STORE_ORDER_FIELDS))}, updated_at
+                    FROM orders WHERE id IN ({', '.join('?' * len(updated))})
+                ''', updated)
+                orders = {order['id']: order for order in c.fetchall()}
+                items = load_order_items(conn, list(orders))
+                for order_id, order in orders.items():
+                    order['products'] = json.loads(items[order_id])
+
+        return jsonify({
+            "orders": [orders[order_id] for order_id in updated],
+            "deleted": deleted,
+            "reset": reset,
+            "has_more": has_more,
+            "sync_token": sync.encode_token('order', position)
+        }), 200
+    except Exception as e:
+        logger.exception("Error syncing orders")
+        return jsonify({"error": str(e)}), 500
         
+def order_event_payloads(storeId, after_id):
+    """Events of a store after ``after_id``, with created orders in full."""
+    with shards.orders_db(storeId) as conn:
+        rows = events.read_events(conn, storeId, after_id)
+        created_ids = [order_id for _, order_id, event_type in rows if event_type == 'created']
+        orders = {}
+        if created_ids:
+            c = conn.cursor()
+            c.row_factory = dict_factory
+            c.execute(f'''
+                SELECT {', '.join(order_columns(STORE_ORDER_FIELDS))}
+                FROM orders WHERE id IN ({', '.join('?' * len(created_ids))})
+            ''', created_ids)
+            orders = {order['id']: order for order in c.fetchall()}
+            items = load_order_items(conn, list(orders))
+            for order_id, order in orders.items():
+                order['products'] = json.loads(items[order_id])
+
+    payloads = []
+    for event_id, order_id, event_type in rows:
+        payload = {"id": event_id, "type": event_type, "order_id": order_id}
+        # The order may have been deleted since
+        if event_type == 'created' and order_id in orders:
+            payload["order"] = orders[order_id]
+        payloads.append(payload)
+    return payloads
+
+@app.route('/orders/<int:storeId>/events', methods=['GET'])
+@store_token_required(token_arg='token')
+def stream_order_events(storeId):
+    """New orders and delivery confirmations of a store, as they happen.
+
+    Served as Server-Sent Events; EventSource resumes from Last-Event-ID on
+    its own. With ``poll=1`` it is a long poll instead: the events after
+    ``since_id`` as JSON, waiting up to ``wait`` seconds for one. Without a
+    cursor only events from now on are returned.
+    """
+    broker = events.broker_for(shards.orders_path(storeId))
+    since_id = request.args.get('since_id', request.headers.get('Last-Event-ID'))
+    try:
+        since_id = broker.last_id() if since_id is None else int(since_id)
+    except ValueError:
+        return jsonify({"error": "since_id must be an integer"}), 400
+
+    if parse_bool_arg('poll'):
+        try:
+            wait = parse_float_arg('wait', 0, minimum=0, maximum=25)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        seen = broker.last_id()
+        payloads = order_event_payloads(storeId, since_id)
+        if not payloads and wait:
+            # A waiting poll holds its thread like a stream, so it takes a
+            # stream slot; otherwise polls could occupy every thread
+            if not events.open_stream():
+                response = jsonify({"error": "Too many waiting requests, retry or poll with wait=0"})
+                response.headers['Retry-After'] = '1'
+                return response, 503
+            try:
+                if broker.wait(seen, wait):
+                    payloads = order_event_payloads(storeId, since_id)
+            finally:
+                events.close_stream()
+        last_id = payloads[-1]['id'] if payloads else max(since_id, seen)
+        return jsonify({"events": payloads, "last_id": last_id}), 200
+
+    if not events.open_stream():
+        response = jsonify({"error": "Too many open event streams, use poll=1 with wait=0"})
+        response.headers['Retry-After'] = str(events.EVENTS_KEEPALIVE_SECONDS)
+        return response, 503
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            last_id = since_id
+            deadline = time.monotonic() + events.EVENTS_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                # Taken before reading so an event landing in between still wakes us
+                seen = broker.last_id()
+                payloads = []
+                if broker.may_have_events(storeId, last_id):
+                    payloads = order_event_payloads(storeId, last_id)
+                for payload in payloads:
+                    yield f"id: {payload['id']}\nevent: order_{payload['type']}\ndata: {json.dumps(payload)}\n\n"
+                    last_id = payload['id']
+                if payloads:
+                    continue
+                if not broker.wait(seen, events.EVENTS_KEEPALIVE_SECONDS):
+                    yield ': keepalive\n\n'
+        finally:
+            events.close_stream()
+
+    response = app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/orders/<storeId>/batch', methods=['POST'])
+def create_orders_batch(storeId):
+    """Insert many orders in one transaction.
+
+    Takes a JSON array of orders (or ``{"orders": [...]}``), each validated
+    like a single order and carrying an ``idempotency_key``. Orders whose key
+    was already stored for the store are reported as duplicates with their
+    existing id, so a kiosk can safely replay a batch after a network drop.
+    """
+    try:
+        payload = request.get_json()
+        orders = payload.get('orders') if isinstance(payload, dict) else payload
+        if not isinstance(orders, list) or not orders:
+            return jsonify({"error": "Expected a non-empty list of orders"}), 400
+        if len(orders) > MAX_BATCH_ORDERS:
+            return jsonify({"error": f"At most {MAX_BATCH_ORDERS} orders per batch"}), 400
+
+        results = [None] * len(orders)
+        pending = {}
+        for index, data in enumerate(orders):
+            error_msg = validate_order(data)
+            if not error_msg and not data.get('idempotency_key'):
+                error_msg = "Missing required field: idempotency_key"
+            if not error_msg and str(data['store_id']) != storeId:
+                error_msg = "store_id does not match the batch store"
+            if error_msg:
+                results[index] = {"index": index, "status": "error", "error": error_msg}
+            elif data['idempotency_key'] in pending:
+                results[index] = {"index": index, "status": "duplicate"}
+            else:
+                pending[data['idempotency_key']] = index
+
+        if not known_ids('stores', [storeId]):
+            return jsonify({"error": "Store not found"}), 404
+        # Unknown clients are dropped like in a single order. Clients are
+        # never deleted, so they can be read before the orders transaction
+        known_clients = known_ids('clients', [orders[index]['client_id'] for index in pending.values()])
+        for index in pending.values():
+            if str(orders[index]['client_id']) not in known_clients:
+                orders[index]['client_id'] = None
+
+        with shards.orders_db(storeId, immediate=True) as conn:
+            c = conn.cursor()
+            keys = list(pending)
+            placeholders = ', '.join('?' * len(keys))
+
+            existing = {}
+            if keys:
+                c.execute(f'''
+                    SELECT idempotency_key, id FROM orders
+                    WHERE store_id = ? AND idempotency_key IN ({placeholders})
+                ''', [storeId] + keys)
+                existing = dict(c.fetchall())
+
+            new_orders = []
+            for key, index in pending.items():
+                if key in existing:
+                    results[index] = {"index": index, "status": "duplicate", "order_id": existing[key]}
+                else:
+                    new_orders.append((key, index))
+
+            if new_orders:
+                c.executemany(INSERT_ORDER_SQL, [order_row(orders[index]) for _, index in new_orders])
+                c.execute(f'''
+                    SELECT idempotency_key, id FROM orders
+                    WHERE store_id = ? AND idempotency_key IN ({', '.join('?' * len(new_orders))})
+                ''', [storeId] + [key for key, _ in new_orders])
+                order_ids = dict(c.fetchall())
+
+                item_rows = []
+                for key, index in new_orders:
+                    results[index] = {"index": index, "status": "created", "order_id": order_ids[key]}
+                    item_rows += order_item_rows(order_ids[key], orders[index])
+                c.executemany(INSERT_ORDER_ITEMS_SQL, item_rows)
+
+        # Keys repeated inside the batch share the outcome of their first copy
+        for index, result in enumerate(results):
+            if result['status'] == 'duplicate' and 'order_id' not in result:
+                first = results[pending[orders[index]['idempotency_key']]]
+                if first['status'] == 'error':
+                    results[index] = {**first, "index": index}
+                else:
+                    result['order_id'] = first['order_id']
+
+        summary = {status: sum(1 for result in results if result['status'] == status)
+                   for status in ('created', 'duplicate', 'error')}
+        if summary['created']:
+            events.broker_for(shards.orders_path(storeId)).notify()
+        return jsonify({"results": results, **summary}), 201 if summary['created'] else 200
+
+    except sqlite3.Error as e:
+        error_msg = f"Database error: {str(e)}"
+        logger.exception(error_msg)
+        return jsonify({"error": error_msg}), 500
+    except Exception as e:
+        error_msg = f"Unexpected error: {str(e)}"
+        logger.exception(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+MAX_NEAREST_ORDERS = 100
+MAX_ROUTE_ORDERS = 200
+
+def parse_float_arg(name, default=None, minimum=None, maximum=None):
+    value = request.args.get(name)
+    if value is None:
+        if default is None:
+            raise ValueError(f"Missing required parameter: {name}")
+        return default
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name} value: {value}")
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum) or value != value:
+        raise ValueError(f"{name} must be between {minimum} and {maximum}")
+    return value
+
+@app.route('/orders/<int:storeId>/nearby', methods=['GET'])
+@store_token_required()
+def get_nearby_orders(storeId):
+    """Undelivered orders around a driver.
+
+    ``lat``/``lng`` with ``radius_km`` returns every order in the circle,
+    with ``k`` instead the k nearest; ``min_lat``, ``max_lat``, ``min_lng``
+    and ``max_lng`` return the orders in a box. Results are read through
+    the orders_geo R*Tree.
+    """
+    try:
+        if 'min_lat' in request.args:
+            box = (
+                parse_float_arg('min_lat', minimum=-90, maximum=90),
+                parse_float_arg('max_lat', minimum=-90, maximum=90),
+                parse_float_arg('min_lng', minimum=-180, maximum=180),
+                parse_float_arg('max_lng', minimum=-180, maximum=180),
+            )
+            with shards.orders_db(storeId) as conn:
+                orders = geo.orders_in_box(conn, storeId, *box)
+            return jsonify({"orders": orders}), 200
+
+        lat = parse_float_arg('lat', minimum=-90, maximum=90)
+        lng = parse_float_arg('lng', minimum=-180, maximum=180)
+        with shards.orders_db(storeId) as conn:
+            if 'k' in request.args:
+                k = int(parse_float_arg('k', minimum=1, maximum=MAX_NEAREST_ORDERS))
+                orders = geo.nearest_orders(conn, storeId, lat, lng, k)
+            else:
+                radius_km = parse_float_arg('radius_km', 5, minimum=0, maximum=geo.MAX_SEARCH_RADIUS_KM)
+                orders = geo.orders_within(conn, storeId, lat, lng, radius_km)
+        return jsonify({"orders": orders}), 200
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception("Error fetching nearby orders")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/orders/<int:storeId>/route', methods=['POST'])
+@store_token_required()
+def plan_delivery_route(storeId):
+    """Greedy visiting order for a batch of undelivered orders.
+
+    Takes ``{"latitude", "longitude", "order_ids"}``; without ``order_ids``
+    the ``k`` (default 10) orders nearest to the start are routed.
+    """
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be an object"}), 400
+        try:
+            lat = float(data['latitude'])
+            lng = float(data['longitude'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "latitude and longitude are required"}), 400
+        try:
+            k = max(1, min(int(data.get('k', 10)), MAX_ROUTE_ORDERS))
+        except (TypeError, ValueError):
+            return jsonify({"error": "k must be an integer"}), 400
+
+        order_ids = data.get('order_ids')
+        with shards.orders_db(storeId) as conn:
+            if order_ids is None:
+                orders = geo.nearest_orders(conn, storeId, lat, lng, k)
+            else:
+                if not isinstance(order_ids, list) or len(order_ids) > MAX_ROUTE_ORDERS:
+                    return jsonify({"error": f"order_ids must be a list of at most {MAX_ROUTE_ORDERS} ids"}), 400
+                c = conn.cursor()
+                c.row_factory = None
+                c.execute(f'''
+                    SELECT {', '.join(geo.GEO_ORDER_FIELDS)} FROM orders
+                    WHERE store_id = ? AND delivered = FALSE
+                    AND id IN ({', '.join('?' * len(order_ids))})
+                    -- Located orders only, as in orders_geo: 0, 0 means no coordinates
+                    AND latitude IS NOT NULL AND longitude IS NOT NULL
+                    AND NOT (latitude = 0 AND longitude = 0)
+                ''', [storeId] + order_ids)
+                orders = [dict(zip(geo.GEO_ORDER_FIELDS, row)) for row in c.fetchall()]
+
+        route = geo.delivery_route(lat, lng, orders)
+        return jsonify({
+            "route": route,
+            "total_km": sum(order['leg_km'] for order in route)
+        }), 200
+
+    except Exception as e:
+        logger.exception("Error planning delivery route")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/confirm_delivery/<int:order_id>', methods=['POST'])
+@store_token_required()
 def confirm_delivery(order_id):
-    print(f"Received POST request to /confirm_delivery/{order_id}")
     try:
-        print("Attempting to confirm delivery of order")
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
-        c.execute('SELECT * FROM orders WHERE id=?', (order_id,))
-        order = c.fetchone()
-        if order:
-            c.execute('UPDATE orders SET delivered=? WHERE id=?', (True, order_id))
-            conn.commit()
-            conn.close()
-            print("Successfully confirmed delivery of order")
+        path = shards.order_path(order_id)
+        # Another store's order is not found, like in the batch endpoint.
+        # Read here, the group commit thread has no request context
+        store_id = g.store_id
+        delivered = None
+        # Without sharding orders are in the repository's own database
+        if path is not None or not shards.SHARD_COUNT:
+            delivered = groupcommit.run(
+                lambda conn: repository.confirm_delivery(conn, order_id, store_id), path
+            )
+        if delivered is not None:
+            # A repeated confirmation changes nothing and has no event to announce
+            if delivered:
+                events.broker_for(path or db.DATABASE_PATH).notify()
+            logger.info("Confirmed delivery of order", extra={'order_id': order_id})
             return jsonify({'message': 'Order confirmed as delivered'}), 200
-        conn.close()
-        print("Order not found in database")
+        logger.info("Order not found in database", extra={'order_id': order_id})
         return jsonify({'error': 'Order not found'}), 404
-    except Exception as e:
-        print(f"Error confirming delivery: {str(e)}")
-        print(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+    except Exception:
+        logger.exception("Error confirming delivery")
+        return jsonify({"error": "An error occurred while confirming the delivery"}), 500
+
+@app.route('/confirm_delivery', methods=['POST'])
+@store_token_required()
+def confirm_deliveries():
+    """Confirm many of the token's store's deliveries at once.
+
+    Takes ``{"order_ids": [...]}`` and returns the ids sorted into
+    ``confirmed``, ``already_delivered`` and ``not_found``; orders of other
+    stores are not found.
+    """
+    try:
+        payload = request.get_json(silent=True)
+        order_ids = payload.get('order_ids') if isinstance(payload, dict) else None
+        if not isinstance(order_ids, list) or not order_ids:
+            return jsonify({"error": "Expected a non-empty list of order_ids"}), 400
+        if len(order_ids) > MAX_BATCH_ORDERS:
+            return jsonify({"error": f"At most {MAX_BATCH_ORDERS} orders per batch"}), 400
+        if not all(isinstance(order_id, int) and not isinstance(order_id, bool) for order_id in order_ids):
+            return jsonify({"error": "order_ids must be integers"}), 400
+        order_ids = list(dict.fromkeys(order_ids))
+
+        found = {}
+        for path, ids in shards.group_orders(order_ids, g.store_id).items():
+            with repository.transaction(path) as conn:
+                delivered = repository.confirm_deliveries(conn, ids, g.store_id)
+            if any(delivered.values()):
+                events.broker_for(path or db.DATABASE_PATH).notify()
+            found.update(delivered)
+
+        logger.info("Confirmed deliveries", extra={'orders': len(order_ids)})
+        return jsonify({
+            "confirmed": [order_id for order_id in order_ids if found.get(order_id) is True],
+            "already_delivered": [order_id for order_id in order_ids if found.get(order_id) is False],
+            "not_found": [order_id for order_id in order_ids if order_id not in found]
+        }), 200
+    except Exception:
+        logger.exception("Error confirming deliveries")
+        return jsonify({"error": "An error occurred while confirming the deliveries"}), 500
+
+PLAN_DURATION_DAYS = 30
 
 @app.route('/store/plan/<code>', methods=['POST'])
 def update_plan(code):
@@ -443,34 +1243,20 @@ def update_plan(code):
         if new_plan not in ['free', 'pro']:
             return jsonify({"error": "Plan must be either 'free' or 'pro'"}), 400
             
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
-        
-        # تحديث خطة المحل
-        c.execute('''
-            UPDATE stores 
-            SET plan = ?, plan_updated_at = CURRENT_TIMESTAMP 
-            WHERE code = ?
-        ''', (new_plan, code))
-        
-        # تحديث الخطط المنتهية (أكثر من 30 يوم)
-        c.execute('''
-            UPDATE stores 
-            SET plan = 'free', 
-                plan_updated_at = CURRENT_TIMESTAMP 
-            WHERE plan = 'pro' 
-            AND julianday('now') - julianday(plan_updated_at) >= 30
-        ''')
+        # Expired pro plans are reset by the maintenance runner, see maintenance.py
+        expires_at = None
+        if new_plan == 'pro':
+            expires_at = repository.utcnow() + timedelta(days=PLAN_DURATION_DAYS)
 
-        
-        conn.commit()
-        conn.close()
+        with repository.transaction() as conn:
+            # تحديث خطة المحل
+            repository.set_plan(conn, code, new_plan, expires_at)
         
         return jsonify({"message": "Plan updated successfully"}), 200
         
-    except Exception as e:
-        print("Error:", str(e))
-        return jsonify({"error": str(e)}), 500
+    except Exception:
+        logger.exception("Error updating plan")
+        return jsonify({"error": "An error occurred while updating the plan"}), 500
 
 @app.route('/register_client', methods=['POST'])
 def register_client():
@@ -483,31 +1269,29 @@ def register_client():
         if not all([name, phone_number, store_id]):
             return jsonify({'error': 'Missing required fields'}), 400
         
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
-        
         # التحقق من عدم وجود رقم الهاتف مسبقاً لنفس المتجر
-        c.execute('SELECT id FROM clients WHERE phone_number = ? AND store_id = ?', (phone_number, store_id))
-        existing_client = c.fetchone()
-        
-        if existing_client:
-            return jsonify({'client_id': existing_client[0]}), 200
-            
-        c.execute('''
-            INSERT INTO clients (name, phone_number, store_id)
-            VALUES (?, ?, ?)
-        ''', (name, phone_number, store_id))
-        
-        client_id = c.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'client_id': client_id}), 201
+        client_id, created = groupcommit.run(
+            lambda conn: repository.get_or_create_client(conn, store_id, name, phone_number)
+        )
+
+        return jsonify({'client_id': client_id}), 201 if created else 200
         
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    except Exception:
+        # The error text carries the SQL parameters, the customer's phone number among them
+        logger.exception("Error registering client")
+        return jsonify({'error': 'An error occurred while registering the client'}), 500
+
+def parse_datetime_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+def hour_bucket(moment):
+    return moment.strftime('%Y-%m-%d %H:00:00')
 
 @app.route('/api/store_stats/<store_id>', methods=['GET'])
+@store_token_required()
 def get_store_statistics(store_id):
     try:
         # Get current date and time
@@ -516,91 +1300,176 @@ def get_store_statistics(store_id):
         week_start = today_start - timedelta(days=7)
         month_start = today_start - timedelta(days=30)
 
-        # Basic statistics
-        conn = sqlite3.connect('orders.db')
-        conn.row_factory = dict_factory
-        cur = conn.cursor()
-
-        cur.execute('SELECT COUNT(*) as total_clients FROM clients WHERE store_id = ?', (store_id,))
-        total_clients = cur.fetchone()['total_clients']
-
-        cur.execute('SELECT COUNT(*) as total_orders FROM orders WHERE store_id = ?', (store_id,))
-        total_orders = cur.fetchone()['total_orders']
-
-        # Today's statistics
-        cur.execute('SELECT COUNT(*) as today_orders FROM orders WHERE store_id = ? AND created_at >= ?', (store_id, today_start))
-        today_orders = cur.fetchone()['today_orders']
-        cur.execute('SELECT SUM(total) as today_revenue FROM orders WHERE store_id = ? AND created_at >= ?', (store_id, today_start))
-        today_revenue = cur.fetchone()['today_revenue'] or 0
-
-        # Weekly statistics
-        cur.execute('SELECT COUNT(*) as week_orders FROM orders WHERE store_id = ? AND created_at >= ?', (store_id, week_start))
-        week_orders = cur.fetchone()['week_orders']
-        cur.execute('SELECT SUM(total) as week_revenue FROM orders WHERE store_id = ? AND created_at >= ?', (store_id, week_start))
-        week_revenue = cur.fetchone()['week_revenue'] or 0
-
-        # Monthly statistics
-        cur.execute('SELECT COUNT(*) as month_orders FROM orders WHERE store_id = ? AND created_at >= ?', (store_id, month_start))
-        month_orders = cur.fetchone()['month_orders']
-        cur.execute('SELECT SUM(total) as month_revenue FROM orders WHERE store_id = ? AND created_at >= ?', (store_id, month_start))
-        month_revenue = cur.fetchone()['month_revenue'] or 0
-
-        # Order status statistics
-        cur.execute('SELECT COUNT(*) as pending_orders FROM orders WHERE store_id = ? AND status = "pending"', (store_id,))
-        pending_orders = cur.fetchone()['pending_orders']
-        cur.execute('SELECT COUNT(*) as delivered_orders FROM orders WHERE store_id = ? AND delivered = TRUE', (store_id,))
-        delivered_orders = cur.fetchone()['delivered_orders']
-
-        # Latest orders
-        cur.execute('SELECT id, total, created_at FROM orders WHERE store_id = ? ORDER BY created_at DESC LIMIT 5', (store_id,))
-        latest_orders = cur.fetchall()
-
-        latest_orders_data = [{
-            'id': order['id'],
-            'total': float(order['total']),
-            'created_at': order['created_at']
-        } for order in latest_orders]
-
-        # Top 3 clients this week
-        cur.execute('''
-            SELECT 
-                c.id,
-                c.name,
-                c.phone_number,
-                COUNT(o.id) as orders_count,
-                SUM(o.total) as total_spent
-            FROM clients c
-            JOIN orders o ON c.id = o.client_id
-            WHERE o.store_id = ? 
-            AND o.created_at >= ?
-            GROUP BY c.id
-            ORDER BY total_spent DESC
-            LIMIT 3
-        ''', (store_id, week_start))
+        # Optional custom range, in whole hours like the rollups it is read from
+        try:
+            range_from = parse_datetime_arg('from')
+            range_to = parse_datetime_arg('to')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        interval = request.args.get('interval')
+        if interval not in (None, 'daily', 'hourly'):
+            return jsonify({'error': "interval must be 'daily' or 'hourly'"}), 400
+
+        # Clients are in the main database, orders and rollups may be in a shard
+        with get_db(dict_factory) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) as total_clients FROM clients WHERE store_id = ?', (store_id,))
+            total_clients = cur.fetchone()['total_clients']
+
+        with shards.orders_db(store_id, dict_factory) as conn:
+            cur = conn.cursor()
+
+            # Every counter comes from one pass over the store's hourly rollups,
+            # so the cost does not grow with the number of orders
+            cur.execute('''
+                SELECT
+                    COALESCE(SUM(orders_count), 0) as total_orders,
+                    COALESCE(SUM(CASE WHEN hour >= :today THEN orders_count END), 0) as today_orders,
+                    COALESCE(SUM(CASE WHEN hour >= :today THEN revenue END), 0) as today_revenue,
+                    COALESCE(SUM(CASE WHEN hour >= :week THEN orders_count END), 0) as week_orders,
+                    COALESCE(SUM(CASE WHEN hour >= :week THEN revenue END), 0) as week_revenue,
+                    COALESCE(SUM(CASE WHEN hour >= :month THEN orders_count END), 0) as month_orders,
+                    COALESCE(SUM(CASE WHEN hour >= :month THEN revenue END), 0) as month_revenue,
+                    COALESCE(SUM(pending_count), 0) as pending_orders,
+                    COALESCE(SUM(delivered_count), 0) as delivered_orders,
+                    COALESCE(SUM(CASE WHEN hour >= :range_from AND hour < :range_to THEN orders_count END), 0) as range_orders,
+                    COALESCE(SUM(CASE WHEN hour >= :range_from AND hour < :range_to THEN revenue END), 0) as range_revenue,
+                    COALESCE(SUM(CASE WHEN hour >= :range_from AND hour < :range_to THEN delivered_count END), 0) as range_delivered
+                FROM store_hourly_stats
+                WHERE store_id = :store_id
+            ''', {
+                'store_id': store_id,
+                'today': hour_bucket(today_start),
+                'week': hour_bucket(week_start),
+                'month': hour_bucket(month_start),
+                'range_from': hour_bucket(range_from) if range_from else '',
+                'range_to': hour_bucket(range_to) if range_to else '9999',
+            })
+            totals = cur.fetchone()
+
+            # Latest orders
+            cur.execute('SELECT id, total, created_at FROM orders WHERE store_id = ? ORDER BY created_at DESC LIMIT 5', (store_id,))
+            latest_orders = cur.fetchall()
+
+            latest_orders_data = [{
+                'id': order['id'],
+                'total': float(order['total']),
+                'created_at': order['created_at']
+            } for order in latest_orders]
+
+            # Top 3 clients this week; names are looked up below
+            cur.execute('''
+                SELECT 
+                    client_id as id,
+                    COUNT(id) as orders_count,
+                    SUM(total) as total_spent
+                FROM orders
+                WHERE store_id = ? 
+                AND created_at >= ?
+                AND client_id IS NOT NULL
+                GROUP BY client_id
+                ORDER BY total_spent DESC
+                LIMIT 3
+            ''', (store_id, week_start.strftime('%Y-%m-%d %H:%M:%S')))
+            top_spenders = cur.fetchall()
+
+            # Time series for the requested range
+            series = None
+            if interval:
+                period_length = 10 if interval == 'daily' else 19
+                cur.execute('''
+                    SELECT
+                        substr(hour, 1, ?) as period,
+                        SUM(orders_count) as orders,
+                        SUM(revenue) as revenue,
+                        SUM(delivered_count) as delivered
+                    FROM store_hourly_stats
+                    WHERE store_id = ? AND hour >= ? AND hour < ?
+                    GROUP BY period
+                    ORDER BY period
+                ''', (
+                    period_length,
+                    store_id,
+                    hour_bucket(range_from or month_start),
+                    hour_bucket(range_to) if range_to else '9999',
+                ))
+                series = [{
+                    'period': row['period'],
+                    'orders': row['orders'],
+                    'revenue': float(row['revenue']),
+                    'delivered': row['delivered']
+                } for row in cur.fetchall()]
+
+        clients = {}
+        if top_spenders:
+            with get_db(dict_factory) as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    f"SELECT id, name, phone_number FROM clients WHERE id IN ({', '.join('?' * len(top_spenders))})",
+                    [row['id'] for row in top_spenders]
+                )
+                clients = {row['id']: row for row in cur.fetchall()}
         top_clients = [{
             'id': row['id'],
-            'name': row['name'],
-            'phone': row['phone_number'],
+            'name': clients[row['id']]['name'],
+            'phone': clients[row['id']]['phone_number'],
             'orders_count': row['orders_count'],
             'total_spent': float(row['total_spent'])
-        } for row in cur.fetchall()]
+        } for row in top_spenders if row['id'] in clients]
 
-        conn.close()
-
-        return jsonify({
+        stats = {
             'total_clients': total_clients,
-            'total_orders': total_orders,
-            'today_orders': today_orders,
-            'today_revenue': float(today_revenue),
-            'week_orders': week_orders,
-            'week_revenue': float(week_revenue),
-            'month_orders': month_orders,
-            'month_revenue': float(month_revenue),
-            'pending_orders': pending_orders,
-            'delivered_orders': delivered_orders,
+            'total_orders': totals['total_orders'],
+            'today_orders': totals['today_orders'],
+            'today_revenue': float(totals['today_revenue']),
+            'week_orders': totals['week_orders'],
+            'week_revenue': float(totals['week_revenue']),
+            'month_orders': totals['month_orders'],
+            'month_revenue': float(totals['month_revenue']),
+            'pending_orders': totals['pending_orders'],
+            'delivered_orders': totals['delivered_orders'],
             'latest_orders': latest_orders_data,
             'top_clients': top_clients
-        })
+        }
+        if range_from or range_to:
+            stats['range'] = {
+                'from': hour_bucket(range_from) if range_from else None,
+                'to': hour_bucket(range_to) if range_to else None,
+                'orders': totals['range_orders'],
+                'revenue': float(totals['range_revenue']),
+                'delivered_orders': totals['range_delivered']
+            }
+        if series is not None:
+            stats['series'] = series
+
+        return jsonify(stats)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/store_stats/<store_id>/best_sellers', methods=['GET'])
+@store_token_required()
+def get_best_sellers(store_id):
+    try:
+        limit = min(request.args.get('limit', 10, type=int), 100)
+        with shards.orders_db(store_id, dict_factory) as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT
+                    product_id as id,
+                    MAX(name) as name,
+                    SUM(qty) as quantity,
+                    SUM(qty * unit_price) as revenue,
+                    COUNT(DISTINCT order_id) as orders_count
+                FROM order_items
+                WHERE store_id = ? AND product_id IS NOT NULL
+                GROUP BY product_id
+                ORDER BY quantity DESC
+                LIMIT ?
+            ''', (store_id, limit))
+            best_sellers = cur.fetchall()
+
+        return jsonify({'best_sellers': best_sellers})
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -608,19 +1477,13 @@ def get_store_statistics(store_id):
 @app.route('/store/all', methods=['GET'])
 def get_all_stores():
     try:
-        conn = sqlite3.connect('orders.db')
-        conn.row_factory = dict_factory
-        cur = conn.cursor()
-        
-        cur.execute('SELECT * FROM stores')
-        stores = cur.fetchall()
-        
+        with repository.transaction() as conn:
+            stores = repository.list_stores(conn)
+
         return jsonify({'stores': stores})
     except Exception as e:
-        print(traceback.format_exc())
+        logger.exception("Error fetching stores")
         return jsonify({'error': 'An error occurred while fetching stores'}), 500
-    finally:
-        conn.close()
 
 @app.after_request
 def after_request(response):
@@ -629,15 +1492,9 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,DELETE,OPTIONS')
     return response
 
-def compress_image(image_data, max_size=(800, 800)):
-    img = Image.open(BytesIO(image_data))
-    img.thumbnail(max_size, Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    img.save(buffer, format="JPEG", quality=85)
-    return buffer.getvalue()
-
 init_db()
 
 if __name__ == '__main__':
-    print("Starting server")
+    maintenance.start()
+    logger.info("Starting server")
     app.run(host='0.0.0.0', port=5050, debug=True)
@@ -0,0 +1,117 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Per-endpoint share of INFO/DEBUG records that are kept, e.g.
+# "manage_orders=0.1,get_image=0". Warnings and errors are never sampled.
+LOG_SAMPLE_RATES = {
+    endpoint.strip(): float(rate)
+    for endpoint, rate in (
+        item.split('=', 1) for item in os.environ.get('LOG_SAMPLE_RATES', '').split(',') if '=' in item
+    )
+}
+
+# Customer data that must not reach the logs
+REDACTED_KEYS = {'phone_number', 'phoneNumber', 'phone', 'code', 'latitude', 'longitude', 'image', 'token'}
+
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+logger = logging.getLogger('dilivry')
+
+_queue = queue.SimpleQueue()
+_listener = None
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {key: '[redacted]' if key in REDACTED_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with any ``extra`` fields included."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = redact(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the Flask endpoint and apply its sampling rate."""
+
+    def filter(self, record):
+        from flask import has_request_context, request
+
+        if has_request_context() and not hasattr(record, 'endpoint'):
+            record.endpoint = request.endpoint
+            record.method = request.method
+
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLE_RATES.get(getattr(record, 'endpoint', None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # JSON encoding and the write happen on the listener thread; the
+        # request thread only renders the message and any traceback
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _start_listener():
+    global _listener
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(_queue, handler, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup_logging():
+    """Route the ``dilivry`` logger through a background writer thread."""
+    if logger.handlers:
+        return logger
+
+    handler = _QueueHandler(_queue)
+    handler.addFilter(RequestContextFilter())
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+    _start_listener()
+    # The writer thread does not survive fork, gunicorn workers need their own
+    os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(_stop_listener)
+    return logger
@@ -0,0 +1,114 @@
+import os
+import secrets
+import threading
+import time
+from functools import wraps
+
+from flask import g, jsonify, request
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+# Without a configured key tokens only survive until the server restarts,
+# and workers only agree on them when the app is preloaded (gunicorn.conf.py)
+SECRET_KEY = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
+TOKEN_MAX_AGE = int(os.environ.get('TOKEN_MAX_AGE', 7 * 24 * 3600))
+# 0 lets requests without a token through while dashboards move over to tokens;
+# a token that is sent is always checked
+STORE_AUTH_REQUIRED = os.environ.get('STORE_AUTH_REQUIRED', '1') != '0'
+
+# Login attempts per client address, and failed attempts per store, in each window
+LOGIN_RATE_LIMIT = int(os.environ.get('LOGIN_RATE_LIMIT', 10))
+LOGIN_FAILURE_LIMIT = int(os.environ.get('LOGIN_FAILURE_LIMIT', 20))
+LOGIN_RATE_WINDOW = int(os.environ.get('LOGIN_RATE_WINDOW', 60))
+
+_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='store-login')
+
+
+def issue_token(store_id):
+    return _serializer.dumps({'store_id': int(store_id)})
+
+
+def verify_token(token):
+    """Store id carried by a valid token, or None."""
+    try:
+        return _serializer.loads(token, max_age=TOKEN_MAX_AGE)['store_id']
+    except (BadSignature, SignatureExpired, KeyError, TypeError):
+        return None
+
+
+def _request_token(token_arg=None):
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[len('Bearer '):].strip()
+    if token_arg:
+        return request.args.get(token_arg)
+    return None
+
+
+def store_token_required(*methods, token_arg=None):
+    """Require a store token on the decorated route, for ``methods`` only if given.
+
+    The token is verified in-process. When the route has a store id in its
+    URL the token must belong to that store; the verified id is left in
+    ``g.store_id`` either way. ``token_arg`` also accepts the token from
+    that query parameter, for clients such as EventSource that cannot set
+    headers.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            g.store_id = None
+            if methods and request.method not in methods:
+                return view(*args, **kwargs)
+
+            token = _request_token(token_arg)
+            if token is None:
+                if STORE_AUTH_REQUIRED:
+                    return jsonify({"error": "Missing store token"}), 401
+                return view(*args, **kwargs)
+
+            store_id = verify_token(token)
+            if store_id is None:
+                return jsonify({"error": "Invalid or expired store token"}), 401
+
+            route_store = kwargs.get('storeId', kwargs.get('store_id'))
+            if route_store is not None and str(route_store) != str(store_id):
+                return jsonify({"error": "Token does not grant access to this store"}), 403
+
+            g.store_id = store_id
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+class RateLimiter:
+    """Fixed-window counters kept in this worker process."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _current(self, key):
+        window = int(time.time() // self.window)
+        entry = self._counts.get(key)
+        if entry is None or entry[0] != window:
+            if len(self._counts) > 10000:
+                self._counts = {k: v for k, v in self._counts.items() if v[0] == window}
+            entry = self._counts[key] = [window, 0]
+        return entry
+
+    def retry_after(self, key):
+        """Seconds until ``key`` may try again, 0 when it is under the limit."""
+        with self._lock:
+            if self._current(key)[1] < self.limit:
+                return 0
+            return self.window - int(time.time() % self.window)
+
+    def hit(self, key):
+        with self._lock:
+            self._current(key)[1] += 1
+
+
+login_attempts = RateLimiter(LOGIN_RATE_LIMIT, LOGIN_RATE_WINDOW)
+login_failures = RateLimiter(LOGIN_FAILURE_LIMIT, LOGIN_RATE_WINDOW)
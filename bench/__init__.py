@@ -0,0 +1,6 @@
+"""Load tests against a synthetic database.
+
+    python -m bench.generate --db bench.db --orders 1000000
+    python -m bench.run --db bench.db --copy --target gunicorn --out current.json
+    python -m bench.compare baseline.json current.json
+"""
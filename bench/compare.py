@@ -0,0 +1,69 @@
+"""Compare two bench.run result files and fail on regressions.
+
+    python -m bench.compare baseline.json current.json --tolerance 0.15
+
+Exits with status 1 when an endpoint's p95 or p99 latency grew, or its
+throughput dropped, by more than the tolerance, or when it started
+returning errors.
+"""
+import argparse
+import json
+import sys
+
+# Metric, and whether a higher value is better
+CHECKS = [
+    ('p95_ms', False),
+    ('p99_ms', False),
+    ('throughput_rps', True),
+]
+
+
+def compare(baseline, current, tolerance):
+    regressions = []
+    rows = []
+    labels = sorted(set(baseline['endpoints']) | set(current['endpoints'])) + ['total']
+    for label in labels:
+        before = baseline['total'] if label == 'total' else baseline['endpoints'].get(label)
+        after = current['total'] if label == 'total' else current['endpoints'].get(label)
+        if before is None or after is None:
+            rows.append((label, 'only in ' + ('current' if before is None else 'baseline')))
+            continue
+
+        for metric, higher_is_better in CHECKS:
+            if not before[metric]:
+                continue
+            change = after[metric] / before[metric] - 1
+            rows.append((label, f"{metric:15} {before[metric]:10.2f} -> {after[metric]:10.2f} ({change:+.1%})"))
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{label}: {metric} {change:+.1%}")
+        if after['errors'] and not before['errors']:
+            regressions.append(f"{label}: {after['errors']} errors")
+
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed relative change")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    if baseline['config'] != current['config']:
+        print("Warning: the runs used different settings", file=sys.stderr)
+
+    rows, regressions = compare(baseline, current, args.tolerance)
+    for label, line in rows:
+        print(f"{label:45} {line}")
+    if regressions:
+        print("\nRegressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Build a synthetic orders.db for benchmarking.
+
+    python -m bench.generate --db bench.db --stores 20 --orders 1000000
+
+The same arguments and --seed always produce the same data. The schema
+comes from migrations.py, so the database matches what the app creates.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+import images
+import migrations
+
+CATEGORIES = ['boissons', 'epicerie', 'fruits', 'legumes', 'boulangerie', 'laitier', 'viandes', 'hygiene']
+BATCH_SIZE = 10000
+
+
+def make_jpeg(rng, size=(1024, 768)):
+    """A camera-sized JPEG with enough detail that it does not compress to nothing."""
+    img = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        radius = rng.randrange(20, 200)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    noise = Image.effect_noise(size, 40).convert('RGB')
+    img = Image.blend(img, noise, 0.15)
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generate(path, stores, clients_per_store, products_per_store, image_count, orders, days, seed):
+    if os.path.exists(path):
+        raise SystemExit(f"{path} already exists, remove it or pick another --db")
+
+    rng = random.Random(seed)
+    now = datetime(2025, 1, 1)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    migrations.migrate(conn)
+    c = conn.cursor()
+
+    c.execute('BEGIN')
+    store_rows = [(
+        f'Store {i}',
+        f'{i} rue du Marche',
+        550000000 + i,
+        rng.choice(CATEGORIES),
+        ''.join(rng.choices('ABCDEFGHJKLMNPQRSTUVWXYZ23456789', k=10)),
+        rng.choice(['free', 'pro']),
+        timestamp(now - timedelta(days=days + rng.randrange(365))),
+    ) for i in range(1, stores + 1)]
+    c.executemany('''
+        INSERT INTO stores (id, name, address, phone_number, activity, code, plan, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(i,) + row for i, row in enumerate(store_rows, start=1)])
+
+    c.executemany('''
+        INSERT INTO clients (id, store_id, name, phone_number) VALUES (?, ?, ?, ?)
+    ''', [
+        ((store_id - 1) * clients_per_store + j, store_id, f'Client {j}', f'0{store_id:04d}{j:05d}')
+        for store_id in range(1, stores + 1) for j in range(1, clients_per_store + 1)
+    ])
+
+    image_hashes = []
+    for _ in range(image_count):
+        image_sha, renditions = images.make_renditions(make_jpeg(rng))
+        images.save_renditions(c, image_sha, renditions)
+        image_hashes.append(image_sha)
+
+    products = {}
+    product_rows = []
+    for store_id in range(1, stores + 1):
+        products[store_id] = []
+        for j in range(1, products_per_store + 1):
+            product_id = (store_id - 1) * products_per_store + j
+            product = {
+                'id': product_id,
+                'name': f'Product {j}',
+                'price': round(rng.uniform(20, 5000), 2),
+                'category': rng.choice(CATEGORIES),
+            }
+            products[store_id].append(product)
+            product_rows.append((
+                product_id, store_id, product['name'], f'Description of product {j}', product['price'],
+                product['category'], int(rng.random() < 0.1), timestamp(now - timedelta(days=rng.randrange(days))),
+            ))
+    c.executemany('''
+        INSERT INTO products (id, store_id, name, description, price, category, new, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', product_rows)
+    if image_hashes:
+        c.executemany('INSERT INTO product_images (product_id, image_hash) VALUES (?, ?)',
+                      [(row[0], image_hashes[row[0] % len(image_hashes)]) for row in product_rows])
+    c.execute('COMMIT')
+
+    # A few large stores take most of the orders, as in production
+    store_weights = [1 / rank for rank in range(1, stores + 1)]
+    started = time.perf_counter()
+    for first in range(1, orders + 1, BATCH_SIZE):
+        order_rows = []
+        item_rows = []
+        for order_id in range(first, min(first + BATCH_SIZE, orders + 1)):
+            store_id = rng.choices(range(1, stores + 1), store_weights)[0]
+            client_id = (store_id - 1) * clients_per_store + rng.randrange(1, clients_per_store + 1)
+            lines = [
+                dict(product, quantity=rng.randrange(1, 5))
+                for product in rng.sample(products[store_id], min(rng.randrange(1, 6), products_per_store))
+            ]
+            created_at = now - timedelta(seconds=rng.randrange(days * 86400))
+            order_rows.append((
+                order_id, store_id, client_id, f'Client {client_id}', f'0{client_id:09d}',
+                36.7 + rng.uniform(-0.2, 0.2), 3.05 + rng.uniform(-0.2, 0.2),
+                round(sum(line['price'] * line['quantity'] for line in lines), 2),
+                timestamp(created_at), int(created_at < now - timedelta(days=1)),
+            ))
+            item_rows.extend(migrations.order_item_rows(order_id, store_id, lines))
+
+        c.execute('BEGIN')
+        c.executemany('''
+            INSERT INTO orders
+            (id, store_id, client_id, name, phone_number, latitude, longitude, total, created_at, delivered)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', order_rows)
+        c.executemany('''
+            INSERT INTO order_items (order_id, store_id, product_id, name, category, qty, unit_price, item)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', item_rows)
+        c.execute('COMMIT')
+        print(f"{order_rows[-1][0]}/{orders} orders ({time.perf_counter() - started:.0f} s)", flush=True)
+
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db')
+    parser.add_argument('--stores', type=int, default=20)
+    parser.add_argument('--clients-per-store', type=int, default=500)
+    parser.add_argument('--products-per-store', type=int, default=200)
+    parser.add_argument('--images', type=int, default=50, help="distinct JPEGs shared by the products")
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=180, help="orders are spread over this many days")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    generate(args.db, args.stores, args.clients_per_store, args.products_per_store,
+             args.images, args.orders, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Replay a request mix against the app and record latency, throughput and RSS.
+
+    python -m bench.run --db bench.db --target client --duration 30
+    python -m bench.run --db bench.db --target gunicorn --workers 4
+
+Run it from the repository root on a copy of the database, the mix
+creates orders and confirms deliveries. Results are written as JSON to
+--out for bench.compare.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from bench import workloads
+
+SAMPLE_INTERVAL = 0.05
+
+
+def read_rss(pid):
+    """Resident set size of ``pid`` in bytes, 0 once the process is gone."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_tree(pid):
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, the ppid follows its closing parenthesis
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+    return pids
+
+
+class Recorder:
+    """Collects latencies and tracks peak RSS while each endpoint is in flight."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self.peak_rss = defaultdict(int)
+        self.recording = False
+        self._lock = threading.Lock()
+
+    def start(self, label):
+        with self._lock:
+            self.in_flight[label] += 1
+
+    def finish(self, label, seconds, ok):
+        with self._lock:
+            self.in_flight[label] -= 1
+            if not self.recording:
+                return
+            self.latencies[label].append(seconds)
+            if not ok:
+                self.errors[label] += 1
+
+    def sample(self, rss):
+        with self._lock:
+            self.peak_rss['total'] = max(self.peak_rss['total'], rss)
+            for label, count in self.in_flight.items():
+                if count:
+                    self.peak_rss[label] = max(self.peak_rss[label], rss)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, peak_rss, seconds):
+    count = len(latencies)
+    latencies = sorted(latencies) or [0.0]
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput_rps': round(count / seconds, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+    }
+
+
+class ClientTarget:
+    """The app imported into this process and driven through Flask's test client."""
+
+    def __init__(self, args):
+        os.environ['DATABASE_PATH'] = args.db
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        import app
+        self.app = app.app
+    def pids(self):
+        return [os.getpid()]
+
+    def session(self):
+        client = self.app.test_client()
+
+        def send(method, path, body, headers):
+            response = client.open(path, method=method, json=body, headers=headers)
+            response.get_data()
+            response.close()
+            return response.status_code
+        return send
+
+    def close(self):
+        pass
+
+
+class GunicornTarget:
+    """A local gunicorn serving the app, driven over keep-alive HTTP connections."""
+
+    def __init__(self, args):
+        env = dict(os.environ, DATABASE_PATH=args.db, LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'))
+        self.port = args.port
+        self.process = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn', 'app:app',
+            '--bind', f'127.0.0.1:{self.port}',
+            '--workers', str(args.workers),
+            '--threads', str(args.threads),
+        ], env=env)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=1)
+                conn.request('GET', '/test')
+                conn.getresponse().read()
+                conn.close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.close()
+                    raise SystemExit("gunicorn did not start")
+                time.sleep(0.2)
+
+    def pids(self):
+        # Looked up on every sample, gunicorn may replace a worker
+        return process_tree(self.process.pid)
+
+    def session(self):
+        state = {'conn': None}
+
+        def send(method, path, body, headers):
+            headers = dict(headers)
+            payload = None
+            if body is not None:
+                payload = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            for attempt in range(2):
+                if state['conn'] is None:
+                    state['conn'] = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+                try:
+                    state['conn'].request(method, path, payload, headers)
+                    response = state['conn'].getresponse()
+                    response.read()
+                    if response.will_close:
+                        state['conn'].close()
+                        state['conn'] = None
+                    return response.status
+                except (http.client.HTTPException, OSError):
+                    # The worker closed the idle connection, retry once on a new one
+                    state['conn'].close()
+                    state['conn'] = None
+                    if attempt:
+                        raise
+        return send
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+TARGETS = {'client': ClientTarget, 'gunicorn': GunicornTarget}
+
+
+def run(args):
+    # Dashboard routes need store tokens; minted here with the key the target is given
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    import auth
+    data = workloads.load_data(args.db)
+    tokens = {store_id: auth.issue_token(store_id) for store_id in data['stores']}
+    mix = workloads.MIXES[args.mix]
+    scenarios, weights = list(mix), list(mix.values())
+
+    target = TARGETS[args.target](args)
+    recorder = Recorder()
+    stop = threading.Event()
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000 + index)
+        send = target.session()
+        while not stop.is_set():
+            label, method, path, body, store_id = rng.choices(scenarios, weights)[0](rng, data)
+            headers = {'Authorization': f'Bearer {tokens[store_id]}'} if store_id else {}
+            recorder.start(label)
+            started = time.perf_counter()
+            try:
+                ok = send(method, path, body, headers) < 400
+            except Exception:
+                ok = False
+            recorder.finish(label, time.perf_counter() - started, ok)
+
+    def sampler():
+        while not stop.is_set():
+            recorder.sample(sum(read_rss(pid) for pid in target.pids()))
+            time.sleep(SAMPLE_INTERVAL)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.concurrency)]
+    threads.append(threading.Thread(target=sampler, daemon=True))
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        recorder.recording = True
+        started = time.perf_counter()
+        time.sleep(args.duration)
+        recorder.recording = False
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        target.close()
+
+    if args.target == 'client':
+        # ru_maxrss also catches peaks between two samples
+        recorder.peak_rss['total'] = max(recorder.peak_rss['total'],
+                                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    endpoints = {
+        label: summarize(latencies, recorder.errors[label], recorder.peak_rss[label], elapsed)
+        for label, latencies in sorted(recorder.latencies.items())
+    }
+    all_latencies = [seconds for latencies in recorder.latencies.values() for seconds in latencies]
+    return {
+        'config': {
+            'target': args.target,
+            'mix': args.mix,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'workers': args.workers if args.target == 'gunicorn' else None,
+            'threads': args.threads if args.target == 'gunicorn' else None,
+            'seed': args.seed,
+            'db': os.path.basename(args.db),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'endpoints': endpoints,
+        'total': summarize(all_latencies, sum(recorder.errors.values()), recorder.peak_rss['total'], elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench.db', help="database from bench.generate")
+    parser.add_argument('--copy', action='store_true', help="run against a fresh copy of --db")
+    parser.add_argument('--target', choices=sorted(TARGETS), default='client')
+    parser.add_argument('--mix', choices=sorted(workloads.MIXES), default='mixed')
+    parser.add_argument('--duration', type=float, default=30, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=5, help="seconds run before measuring")
+    parser.add_argument('--concurrency', type=int, default=8, help="client threads")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--threads', type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default='bench-results.json')
+    args = parser.parse_args()
+
+    if args.copy:
+        copy_path = f'{args.db}.run'
+        shutil.copyfile(args.db, copy_path)
+        args.db = copy_path
+
+    results = run(args)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    for label, stats in list(results['endpoints'].items()) + [('total', results['total'])]:
+        print(f"{label:45} {stats['requests']:8} req {stats['throughput_rps']:9.1f} rps "
+              f"p50 {stats['p50_ms']:8.2f} p95 {stats['p95_ms']:8.2f} p99 {stats['p99_ms']:8.2f} ms "
+              f"{stats['errors']:5} err {stats['peak_rss_mb']:7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
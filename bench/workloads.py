@@ -0,0 +1,107 @@
+"""Request mixes replayed by bench.run.
+
+Each scenario takes ``(rng, data)`` and returns
+``(label, method, path, body, store_id)``; ``store_id`` is set for store
+dashboard routes, which are sent with that store's token. ``data`` is
+what ``load_data`` read from the benchmark database.
+"""
+import sqlite3
+import uuid
+from urllib.parse import quote
+
+
+def load_data(path):
+    conn = sqlite3.connect(path)
+    data = {
+        'stores': [row[0] for row in conn.execute('SELECT id FROM stores')],
+        'clients': {},
+        'products': {},
+        'images': [row[0] for row in conn.execute('SELECT DISTINCT image_hash FROM product_images')],
+        'pending_orders': conn.execute(
+            'SELECT id, store_id FROM orders WHERE delivered = 0 ORDER BY id DESC LIMIT 100000'
+        ).fetchall(),
+    }
+    for store_id, client_id in conn.execute('SELECT store_id, id FROM clients'):
+        data['clients'].setdefault(store_id, []).append(client_id)
+    for product_id, store_id, name, price, category in conn.execute(
+        'SELECT id, store_id, name, price, category FROM products'
+    ):
+        data['products'].setdefault(store_id, []).append(
+            {'id': product_id, 'name': name, 'price': price, 'category': category}
+        )
+    conn.close()
+    return data
+
+
+def browse_catalogue(rng, data):
+    store_id = rng.choice(data['stores'])
+    return 'GET /products/<storeId>', 'GET', f'/products/{store_id}', None, None
+
+
+def search_products(rng, data):
+    store_id = rng.choice([store_id for store_id in data['products'] if data['products'][store_id]])
+    # The first letters of a product name, as typed into a search box
+    word = rng.choice(data['products'][store_id])['name'].split()[0]
+    query = word[:rng.randrange(2, len(word) + 1)] if len(word) > 2 else word
+    return 'GET /products/<storeId>/search', 'GET', f'/products/{store_id}/search?q={quote(query)}', None, None
+
+
+def fetch_image(rng, data):
+    image_sha = rng.choice(data['images'])
+    size = rng.choice(['thumb', 'thumb', 'medium', 'full'])
+    return 'GET /images/<sha>', 'GET', f'/images/{image_sha}.jpg?size={size}', None, None
+
+
+def list_orders(rng, data):
+    store_id = rng.choice(data['stores'])
+    return 'GET /orders/<storeId>', 'GET', f'/orders/{store_id}?limit=50', None, store_id
+
+
+def create_order(rng, data):
+    store_id = rng.choice([store_id for store_id in data['stores'] if data['products'].get(store_id)])
+    lines = [dict(product, quantity=rng.randrange(1, 5))
+             for product in rng.sample(data['products'][store_id], min(3, len(data['products'][store_id])))]
+    body = {
+        'store_id': store_id,
+        'client_id': rng.choice(data['clients'][store_id]),
+        'name': 'Bench client',
+        'phoneNumber': '0555000000',
+        'latitude': 36.7,
+        'longitude': 3.05,
+        'total': round(sum(line['price'] * line['quantity'] for line in lines), 2),
+        'products': lines,
+        'idempotency_key': str(uuid.UUID(int=rng.getrandbits(128))),
+    }
+    return 'POST /orders/<storeId>', 'POST', f'/orders/{store_id}', body, None
+
+
+def store_stats(rng, data):
+    store_id = rng.choice(data['stores'])
+    return 'GET /api/store_stats/<storeId>', 'GET', f'/api/store_stats/{store_id}', None, store_id
+
+
+def best_sellers(rng, data):
+    store_id = rng.choice(data['stores'])
+    return 'GET /api/store_stats/<storeId>/best_sellers', 'GET', f'/api/store_stats/{store_id}/best_sellers', None, store_id
+
+
+def confirm_delivery(rng, data):
+    order_id, store_id = rng.choice(data['pending_orders'])
+    return 'POST /confirm_delivery/<orderId>', 'POST', f'/confirm_delivery/{order_id}', None, store_id
+
+
+# Scenario weights per mix, picked with --mix
+MIXES = {
+    'mixed': {
+        browse_catalogue: 30,
+        fetch_image: 25,
+        list_orders: 15,
+        create_order: 15,
+        store_stats: 5,
+        best_sellers: 3,
+        confirm_delivery: 7,
+    },
+    'browse': {browse_catalogue: 40, search_products: 15, fetch_image: 45},
+    'orders': {create_order: 60, list_orders: 25, confirm_delivery: 15},
+    'stats': {store_stats: 70, best_sellers: 30},
+}
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import db
+
+# Serialized catalogues kept per worker process
+CATALOGUE_CACHE_BYTES = int(os.environ.get('CATALOGUE_CACHE_BYTES', 32 * 1024 * 1024))
+# Second tier shared by all workers on the host; empty disables it
+CATALOGUE_SHARED_CACHE_PATH = os.environ.get('CATALOGUE_SHARED_CACHE_PATH', f'{db.DATABASE_PATH}.catalogue_cache')
+
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by the total size of its values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+_catalogues = LRUCache(CATALOGUE_CACHE_BYTES)
+
+
+def init_shared_cache():
+    if not CATALOGUE_SHARED_CACHE_PATH:
+        return
+    conn = db.connect(CATALOGUE_SHARED_CACHE_PATH)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Entries from before they were keyed on the database are dropped
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(catalogue_cache)')]
+    if columns and 'database_id' not in columns:
+        conn.execute('DROP TABLE catalogue_cache')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS catalogue_cache (
+            store_id INTEGER PRIMARY KEY,
+            database_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            etag TEXT NOT NULL,
+            body BLOB NOT NULL
+        )
+    ''')
+    conn.close()
+
+
+def catalogue_version(conn, store_id):
+    """Version of a store's catalogue, as ``(database_id, version)``.
+
+    Triggers bump the version on every product or image write. The
+    database's random id keeps a restored or replaced database, whose
+    counters may repeat, from being served another one's catalogues.
+    """
+    c = conn.cursor()
+    c.row_factory = None
+    c.execute('''
+        SELECT database_identity.id, coalesce(catalogue_versions.version, 0)
+        FROM database_identity
+        LEFT JOIN catalogue_versions ON catalogue_versions.store_id = ?
+    ''', (store_id,))
+    return c.fetchone()
+
+
+def get_catalogue(store_id, version, build):
+    """Return ``(etag, body)`` for a store's catalogue at ``version``.
+
+    Looks in this worker's LRU first, then in the shared cache, and only
+    calls ``build()`` to produce the response bytes when neither holds the
+    current version.
+    """
+    entry = _catalogues.get(store_id)
+    if entry is not None and entry[0] == version:
+        return entry[1], entry[2]
+
+    entry = _shared_get(store_id, version)
+    if entry is None:
+        body = build()
+        etag = hashlib.sha1(body).hexdigest()
+        entry = (version, etag, body)
+        _shared_set(store_id, entry)
+
+    _catalogues.set(store_id, entry, len(entry[2]))
+    return entry[1], entry[2]
+
+
+def _shared_get(store_id, version):
+    if not CATALOGUE_SHARED_CACHE_PATH:
+        return None
+    database_id, number = version
+    with db.get_db(path=CATALOGUE_SHARED_CACHE_PATH) as conn:
+        row = conn.execute('''
+            SELECT etag, body FROM catalogue_cache
+            WHERE store_id = ? AND database_id = ? AND version = ?
+        ''', (store_id, database_id, number)).fetchone()
+    return (version, row[0], row[1]) if row else None
+
+
+def _shared_set(store_id, entry):
+    if not CATALOGUE_SHARED_CACHE_PATH:
+        return
+    (database_id, number), etag, body = entry
+    with db.get_db(path=CATALOGUE_SHARED_CACHE_PATH) as conn:
+        conn.execute('''
+            INSERT INTO catalogue_cache (store_id, database_id, version, etag, body)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (store_id) DO UPDATE SET
+                database_id = excluded.database_id, version = excluded.version,
+                etag = excluded.etag, body = excluded.body
+        ''', (store_id, database_id, number, etag, body))
@@ -0,0 +1,96 @@
+import gzip
+import hashlib
+import os
+
+from flask import request
+
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies fit in a packet or two, compressing them is not worth it
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+# Compressed bodies of responses whose view set an ETag, per worker process
+COMPRESS_CACHE_BYTES = int(os.environ.get('COMPRESS_CACHE_BYTES', 16 * 1024 * 1024))
+GZIP_LEVEL = 6
+# Quality 11 is meant for static assets, 5 compresses JSON better than gzip
+# at a similar speed
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'image/svg+xml',
+}
+
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+_compressed = LRUCache(COMPRESS_CACHE_BYTES)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compressible(response):
+    mimetype = response.mimetype or ''
+    # text/event-stream is streamed anyway; images are compressed already
+    return mimetype in COMPRESSIBLE_MIMETYPES or (mimetype.startswith('text/') and mimetype != 'text/event-stream')
+
+
+def _not_modified(response):
+    response.status_code = 304
+    response.set_data(b'')
+    for header in ('Content-Length', 'Content-Type', 'Content-Encoding'):
+        response.headers.pop(header, None)
+    return response
+
+
+def _after_request(response):
+    # Streams and files are sent as they are read; buffering them here
+    # would defeat that
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    conditional = request.method in ('GET', 'HEAD')
+    etag, weak = response.get_etag()
+    view_etag = etag
+    if etag is None and conditional:
+        etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+        response.set_etag(etag, weak=True)
+        weak = True
+
+    encoding = None
+    if len(data) >= COMPRESS_MIN_SIZE and _compressible(response):
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        # Strong ETags promise byte-identical bodies, which differ per encoding
+        if encoding and etag and not weak:
+            response.set_etag(etag, weak=True)
+
+    if conditional and etag and request.if_none_match.contains_weak(etag):
+        return _not_modified(response)
+
+    if encoding:
+        key = (view_etag, encoding)
+        body = _compressed.get(key) if view_etag else None
+        if body is None:
+            body = compress(data, encoding)
+            if view_etag:
+                _compressed.set(key, body, len(body))
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    """Compress ``app``'s responses and answer If-None-Match on them with 304."""
+    app.after_request(_after_request)
@@ -0,0 +1,191 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'orders.db')
+
+# Idle connections kept per worker process; busier moments open extra
+# connections which are closed again instead of being pooled
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+
+PRAGMAS = (
+    f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Extra pragmas for the connections to one database, by path; see shards.py
+PATH_PRAGMAS = {}
+
+# Set by use_cooperative_busy_wait()
+_busy_sleep = None
+
+# Called as on_query(sql, seconds, executed) after every execute and fetch,
+# see Cursor
+on_query = None
+
+_pools = {}
+_pools_pid = None
+_pool_lock = threading.Lock()
+
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+class Cursor(sqlite3.Cursor):
+    """Cursor that reports the time spent inside SQLite to ``on_query``.
+
+    SQLite produces rows lazily, so fetches are timed as well and charged
+    to the statement that produced them.
+    """
+
+    _sql = None
+
+    def _timed(self, method, args=(), executed=False):
+        if on_query is None:
+            return method(self, *args)
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            on_query(self._sql, time.perf_counter() - started, executed)
+
+    def _execute(self, method, args):
+        if _busy_sleep is None:
+            return self._timed(method, args, True)
+
+        deadline = time.monotonic() + DB_BUSY_TIMEOUT_MS / 1000
+        delay = 0.001
+        while True:
+            try:
+                return self._timed(method, args, True)
+            except sqlite3.OperationalError as e:
+                # A locked statement has not run yet, so it is safe to retry
+                if 'locked' not in str(e) or time.monotonic() >= deadline:
+                    raise
+            _busy_sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        return self._execute(sqlite3.Cursor.execute, (sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        return self._execute(sqlite3.Cursor.executemany, (sql, seq_of_parameters))
+
+    def fetchone(self):
+        return self._timed(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._timed(sqlite3.Cursor.fetchmany, (size,))
+
+    def fetchall(self):
+        return self._timed(sqlite3.Cursor.fetchall)
+
+    def __next__(self):
+        return self._timed(sqlite3.Cursor.__next__)
+
+
+class Connection(sqlite3.Connection):
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(path=None):
+    path = path or DATABASE_PATH
+    conn = sqlite3.connect(
+        path,
+        timeout=0 if _busy_sleep else DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        factory=Connection,
+    )
+    for pragma in PRAGMAS + PATH_PRAGMAS.get(path, ()):
+        conn.execute(pragma)
+    if _busy_sleep:
+        conn.execute('PRAGMA busy_timeout = 0')
+    return conn
+
+
+def use_cooperative_busy_wait(sleep):
+    """Wait for locks with ``sleep`` instead of inside SQLite.
+
+    SQLite's busy handler sleeps in C. Under gevent that blocks every
+    greenlet of the worker, including the one holding the lock, so each
+    wait runs out the full timeout. With this the handler is off and
+    locked statements are retried after ``sleep``, which yields.
+    Call it before the first connection is opened.
+    """
+    global _busy_sleep
+    _busy_sleep = sleep
+
+
+def _get_pool(path):
+    global _pools, _pools_pid
+    with _pool_lock:
+        # Connections must never be shared across a fork
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        if path not in _pools:
+            _pools[path] = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        return _pools[path]
+
+
+def _acquire(path):
+    try:
+        return _get_pool(path).get_nowait()
+    except queue.Empty:
+        return connect(path)
+
+
+def _release(conn, path):
+    conn.row_factory = None
+    try:
+        _get_pool(path).put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def get_db(row_factory=None, path=None, immediate=False):
+    """Borrow a pooled connection for the duration of a ``with`` block.
+
+    The transaction is committed when the block exits normally and rolled
+    back if it raises; either way the connection goes back to the pool.
+    ``path`` selects a database other than DATABASE_PATH. Pass
+    ``immediate=True`` when the block reads before it writes: it takes the
+    write lock up front, so the reads cannot go stale before the write.
+    """
+    path = path or DATABASE_PATH
+    conn = _acquire(path)
+    conn.row_factory = row_factory
+    try:
+        if immediate:
+            conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _release(conn, path)
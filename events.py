@@ -0,0 +1,169 @@
+import os
+import threading
+from collections import deque
+
+import db
+
+# How often each worker looks for events committed by other workers
+ORDER_EVENTS_POLL_SECONDS = float(os.environ.get('ORDER_EVENTS_POLL_SECONDS', 0.5))
+# Open event streams and waiting long polls per worker; each one holds a
+# gthread thread, so keep this below the thread count (gunicorn.conf.py sets it)
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 2))
+# Streams end after this long and the browser's EventSource reconnects
+EVENTS_STREAM_SECONDS = int(os.environ.get('EVENTS_STREAM_SECONDS', 300))
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_BUFFER_SIZE = 10000
+EVENTS_BATCH_SIZE = 500
+
+
+def read_events(conn, store_id, after_id, limit=EVENTS_BATCH_SIZE):
+    """``(id, order_id, type)`` of a store's events after ``after_id``, oldest first."""
+    c = conn.cursor()
+    c.row_factory = None
+    c.execute('''
+        SELECT id, order_id, type FROM order_events
+        WHERE store_id = ? AND id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (store_id, after_id, limit))
+    return c.fetchall()
+
+
+_streams = 0
+_streams_lock = threading.Lock()
+
+
+def open_stream():
+    """Count a new stream against EVENTS_MAX_STREAMS, False when none is left."""
+    global _streams
+    with _streams_lock:
+        if _streams >= EVENTS_MAX_STREAMS:
+            return False
+        _streams += 1
+        return True
+
+
+def close_stream():
+    global _streams
+    with _streams_lock:
+        _streams -= 1
+
+
+class EventBroker:
+    """Fans the order_events of one database out to the streams open in this worker.
+
+    One thread per worker polls order_events and keeps the newest rows in
+    memory; streams wait on a condition instead of each querying the
+    database. Workers share nothing but the table, so an event written by
+    any of them shows up everywhere within ORDER_EVENTS_POLL_SECONDS.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._buffer = deque(maxlen=EVENTS_BUFFER_SIZE)
+        self._last_id = 0
+        self._waiting = 0
+        self._pid = None
+
+    def _start(self):
+        with self._cond:
+            # The polling thread does not survive a fork
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._buffer.clear()
+            with db.get_db(path=self.path) as conn:
+                self._last_id = conn.execute('SELECT IFNULL(MAX(id), 0) FROM order_events').fetchone()[0]
+        threading.Thread(target=self._poll, name='order-events', daemon=True).start()
+
+    def _poll(self):
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    self._cond.wait()
+                last_id = self._last_id
+
+            with db.get_db(path=self.path) as conn:
+                c = conn.cursor()
+                c.row_factory = None
+                c.execute('''
+                    SELECT id, store_id, order_id, type FROM order_events
+                    WHERE id > ? ORDER BY id LIMIT ?
+                ''', (last_id, EVENTS_BATCH_SIZE))
+                rows = c.fetchall()
+
+            if rows:
+                with self._cond:
+                    # _refresh() moved past these meanwhile; read again from there
+                    if self._last_id != last_id:
+                        continue
+                    self._buffer.extend(rows)
+                    self._last_id = rows[-1][0]
+                    self._cond.notify_all()
+                if len(rows) == EVENTS_BATCH_SIZE:
+                    continue
+            self._wake.wait(ORDER_EVENTS_POLL_SECONDS)
+            self._wake.clear()
+
+    def notify(self):
+        """Poll now, after this worker wrote an event."""
+        self._wake.set()
+
+    def _refresh(self):
+        with db.get_db(path=self.path) as conn:
+            latest = conn.execute('SELECT IFNULL(MAX(id), 0) FROM order_events').fetchone()[0]
+        with self._cond:
+            if latest > self._last_id:
+                # The events skipped over are not buffered, so the buffer
+                # no longer proves a store has none
+                self._buffer.clear()
+                self._last_id = latest
+                self._cond.notify_all()
+
+    def last_id(self):
+        """Id of the newest event in the database."""
+        self._start()
+        # The polling thread sleeps while nobody waits, and its id falls behind
+        with self._cond:
+            idle = not self._waiting
+        if idle:
+            self._refresh()
+        with self._cond:
+            return self._last_id
+
+    def wait(self, after_id, timeout):
+        """Block until an event newer than ``after_id`` arrives, False on timeout."""
+        self._start()
+        with self._cond:
+            self._waiting += 1
+            self._cond.notify_all()
+            try:
+                return self._cond.wait_for(lambda: self._last_id > after_id, timeout)
+            finally:
+                self._waiting -= 1
+
+    def may_have_events(self, store_id, after_id):
+        """False when the buffer proves the store has nothing after ``after_id``."""
+        with self._cond:
+            if not self._buffer or self._buffer[0][0] > after_id + 1:
+                return True
+            for event_id, event_store, _, _ in reversed(self._buffer):
+                if event_id <= after_id:
+                    return False
+                if event_store == store_id:
+                    return True
+            return False
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def broker_for(path):
+    """The broker of the database at ``path``, see shards.orders_path()."""
+    with _brokers_lock:
+        if path not in _brokers:
+            _brokers[path] = EventBroker(path)
+        return _brokers[path]
@@ -0,0 +1,94 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+# Largest radius the nearest-order search widens to before giving up
+MAX_SEARCH_RADIUS_KM = 500
+
+GEO_ORDER_FIELDS = ['id', 'name', 'phone_number', 'latitude', 'longitude', 'total', 'status', 'created_at']
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle (haversine) distance."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lng, radius_km):
+    """``(min_lat, max_lat, min_lng, max_lng)`` enclosing the circle."""
+    lat_delta = radius_km / KM_PER_DEGREE
+    # Longitude degrees shrink towards the poles; near them take every longitude
+    cos_lat = math.cos(math.radians(lat))
+    lng_delta = 180 if cos_lat < 1e-6 else min(180, radius_km / (KM_PER_DEGREE * cos_lat))
+    return max(-90, lat - lat_delta), min(90, lat + lat_delta), lng - lng_delta, lng + lng_delta
+
+
+def orders_in_box(conn, store_id, min_lat, max_lat, min_lng, max_lng):
+    """Undelivered orders of a store inside the box, read through the orders_geo R*Tree.
+
+    The R*Tree holds 32-bit floats rounded outwards, so its candidates are
+    checked again against the exact coordinates in orders.
+    """
+    c = conn.cursor()
+    c.row_factory = None
+    c.execute(f'''
+        SELECT {', '.join('o.' + field for field in GEO_ORDER_FIELDS)}
+        FROM orders_geo g
+        JOIN orders o ON o.id = g.id
+        WHERE g.min_store >= ? AND g.max_store <= ?
+        AND g.max_lat >= ? AND g.min_lat <= ?
+        AND g.max_lng >= ? AND g.min_lng <= ?
+    ''', (store_id, store_id, min_lat, max_lat, min_lng, max_lng))
+    orders = []
+    for row in c:
+        order = dict(zip(GEO_ORDER_FIELDS, row))
+        if min_lat <= order['latitude'] <= max_lat and min_lng <= order['longitude'] <= max_lng:
+            orders.append(order)
+    return orders
+
+
+def orders_within(conn, store_id, lat, lng, radius_km):
+    """Undelivered orders within ``radius_km``, nearest first, with ``distance_km`` set."""
+    orders = []
+    for order in orders_in_box(conn, store_id, *bounding_box(lat, lng, radius_km)):
+        order['distance_km'] = distance_km(lat, lng, order['latitude'], order['longitude'])
+        if order['distance_km'] <= radius_km:
+            orders.append(order)
+    orders.sort(key=lambda order: order['distance_km'])
+    return orders
+
+
+def nearest_orders(conn, store_id, lat, lng, k, start_radius_km=1):
+    """The ``k`` undelivered orders nearest to a position.
+
+    Searches a small circle and doubles it until it holds ``k`` orders, so
+    the cost follows the orders near the position rather than the store's
+    whole backlog.
+    """
+    radius_km = start_radius_km
+    while True:
+        orders = orders_within(conn, store_id, lat, lng, radius_km)
+        if len(orders) >= k or radius_km >= MAX_SEARCH_RADIUS_KM:
+            return orders[:k]
+        radius_km = min(radius_km * 2, MAX_SEARCH_RADIUS_KM)
+
+
+def delivery_route(lat, lng, orders):
+    """Greedy nearest-neighbour visiting order starting from a position.
+
+    Returns the orders in visiting order, each with ``leg_km`` set to the
+    distance from the previous stop. Not optimal, typically within 25% of
+    the best tour, and cheap enough for a driver's batch.
+    """
+    remaining = list(orders)
+    route = []
+    while remaining:
+        nearest = min(remaining, key=lambda order: distance_km(lat, lng, order['latitude'], order['longitude']))
+        remaining.remove(nearest)
+        nearest['leg_km'] = distance_km(lat, lng, nearest['latitude'], nearest['longitude'])
+        route.append(nearest)
+        lat, lng = nearest['latitude'], nearest['longitude']
+    return route
@@ -0,0 +1,100 @@
+"""Group commit for small, hot writes.
+
+Each commit takes the SQLite write lock and waits for an fsync, which
+bounds how many single-row writes a database takes per second. With
+GROUP_COMMIT_MS set, writes passed to run() from the request threads of a
+worker are queued, and a writer thread runs whatever arrived within that
+window in one transaction. Callers return once the group is committed.
+Workers do not share queues; each groups its own requests.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import repository
+
+# 0 commits every write on its own, in the calling thread
+GROUP_COMMIT_MS = float(os.environ.get('GROUP_COMMIT_MS', 0))
+# Writes per transaction, so a burst does not hold the write lock for long
+GROUP_COMMIT_MAX = int(os.environ.get('GROUP_COMMIT_MAX', 64))
+
+
+class GroupWriter:
+    """Runs the writes queued for one database, a group per transaction."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def _start(self):
+        with self._lock:
+            # The writer thread does not survive a fork
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.SimpleQueue()
+        threading.Thread(target=self._run, name='group-commit', daemon=True).start()
+
+    def submit(self, write):
+        """Run ``write(conn)`` in the next group, returns its result once committed."""
+        self._start()
+        future = Future()
+        self._queue.put((write, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            group = [self._queue.get()]
+            deadline = time.monotonic() + GROUP_COMMIT_MS / 1000
+            while len(group) < GROUP_COMMIT_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit(group)
+
+    def _commit(self, group):
+        try:
+            with repository.transaction(self.path) as conn:
+                results = [write(conn) for write, _ in group]
+        except Exception as e:
+            if len(group) == 1:
+                group[0][1].set_exception(e)
+                return
+            # The whole group was rolled back; retried one by one, only the
+            # write that failed fails
+            for item in group:
+                self._commit([item])
+            return
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def writer_for(path):
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = GroupWriter(path)
+        return _writers[path]
+
+
+def run(write, path=None):
+    """``write(conn)`` in a repository transaction on ``path``, grouped when GROUP_COMMIT_MS is set.
+
+    ``write`` runs again, in a transaction of its own, when another write
+    of its group fails, so it must be safe to repeat.
+    """
+    if not GROUP_COMMIT_MS:
+        with repository.transaction(path) as conn:
+            return write(conn)
+    return writer_for(path).submit(write)
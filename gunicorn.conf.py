@@ -0,0 +1,81 @@
+"""Gunicorn settings, used by the Procfile.
+
+GUNICORN_WORKER_CLASS picks the concurrency model:
+
+- gthread (default): each worker serves requests from a thread pool, so a
+  slow upload or stats query only holds one thread
+- gevent: greenlets, for many slow or idle connections; needs the gevent
+  package, which is not in requirements.txt
+
+Everything can be overridden on the command line as usual.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+cores = multiprocessing.cpu_count()
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# Reported in on_starting, once gunicorn's logger is set up
+gevent_missing = False
+if worker_class == 'gevent':
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        gevent_missing = True
+        worker_class = 'gthread'
+
+# SQLite takes one writer at a time, more processes than cores only adds
+# lock contention; threads or greenlets cover the waiting on I/O
+workers = int(os.environ.get('WEB_CONCURRENCY', cores))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+# Each open event stream or waiting long poll holds a thread (or greenlet)
+# until it ends; leave room for ordinary requests
+os.environ.setdefault('EVENTS_MAX_STREAMS', str(
+    worker_connections // 2 if worker_class == 'gevent' else max(1, threads // 2)
+))
+
+# The Procfile's platform puts one router in front of the app; it sets
+# X-Forwarded-For, which the login rate limits need for the client address
+os.environ.setdefault('TRUSTED_PROXY_COUNT', '1')
+
+# Import the app and run init_db() once in the master, workers are forked
+# with migrations already applied
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+# Heartbeat files on tmpfs, a slow disk would make idle workers look stuck
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Let /metrics add up all workers, see metrics.py. Must be set before the
+# app is preloaded
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'dilivry-metrics-{os.getpid()}'))
+
+
+def on_starting(server):
+    if gevent_missing:
+        server.log.warning("gevent is not installed, falling back to gthread workers")
+    # Totals of a previous run must not be added to this one
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+
+
+def post_worker_init(worker):
+    if worker_class == 'gevent':
+        import gevent
+
+        import db
+        db.use_cooperative_busy_wait(gevent.sleep)
+
+    # Every worker runs the scheduler, a file lock lets one of them do the work
+    import maintenance
+    maintenance.start()
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image, features
+
+import metrics
+
+# Renditions generated at upload, picked with ?size= on /images/<sha>.<ext>
+RENDITIONS = {
+    'thumb': (160, 160),
+    'medium': (400, 400),
+    'full': (800, 800),
+}
+DEFAULT_RENDITION = 'full'
+
+FORMATS = {'jpg': 'JPEG'}
+if features.check('webp'):
+    FORMATS['webp'] = 'WEBP'
+
+MIMETYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+# 'db' keeps the bytes as BLOBs in image_renditions, 'files' writes them under MEDIA_DIR
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 'db')
+MEDIA_DIR = os.environ.get('MEDIA_DIR', 'media')
+
+# Uploads are resized in a process pool; once IMAGE_QUEUE_LIMIT uploads are
+# in flight further ones are refused so clients back off instead of piling up
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_LIMIT = int(os.environ.get('IMAGE_QUEUE_LIMIT', 8))
+IMAGE_RETRY_AFTER = 5
+
+logger = logging.getLogger('dilivry.images')
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(IMAGE_QUEUE_LIMIT)
+
+
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def compress_image(image_data, max_size=(800, 800), format='JPEG'):
+    img = Image.open(BytesIO(image_data))
+    return encode_image(img, max_size, format)
+
+
+def encode_image(img, max_size, format='JPEG'):
+    img = img.copy()
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, format=format, quality=85)
+    return buffer.getvalue()
+
+
+def make_renditions(image_data, full=None):
+    """Return ``(sha, {(size, ext): bytes})`` for an uploaded image.
+
+    The hash is taken over the full-size JPEG, which is also what older
+    rows stored, so existing image URLs keep working. Pass ``full`` when
+    that JPEG already exists to keep it byte-for-byte.
+    """
+    img = Image.open(BytesIO(image_data))
+    # Let the JPEG decoder downscale by 1/2..1/8 before we resample
+    img.draft('RGB', RENDITIONS['full'])
+    img.load()
+    if full is None:
+        full = encode_image(img, RENDITIONS['full'])
+
+    renditions = {}
+    for size, max_size in RENDITIONS.items():
+        for ext, format in FORMATS.items():
+            if size == 'full' and ext == 'jpg':
+                renditions[(size, ext)] = full
+            else:
+                renditions[(size, ext)] = encode_image(img, max_size, format)
+    return image_hash(full), renditions
+
+
+def _media_path(image_sha, size, ext):
+    return os.path.join(MEDIA_DIR, image_sha[:2], f'{image_sha}-{size}.{ext}')
+
+
+def save_renditions(c, image_sha, renditions):
+    for (size, ext), data in renditions.items():
+        if IMAGE_STORAGE == 'files':
+            path = _media_path(image_sha, size, ext)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        else:
+            c.execute('''
+                INSERT OR IGNORE INTO image_renditions (image_hash, size, format, data)
+                VALUES (?, ?, ?, ?)
+            ''', (image_sha, size, ext, data))
+
+
+def load_rendition(c, image_sha, size, ext):
+    if IMAGE_STORAGE == 'files':
+        try:
+            with open(_media_path(image_sha, size, ext), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    c.execute('''
+        SELECT data FROM image_renditions
+        WHERE image_hash = ? AND size = ? AND format = ?
+    ''', (image_sha, size, ext))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def remove_orphaned_renditions(c, min_age):
+    """Delete renditions no product refers to, returns how many went.
+
+    Files are only removed once older than ``min_age`` seconds: the upload
+    pipeline writes them before the product_images row is committed.
+    """
+    if IMAGE_STORAGE != 'files':
+        c.execute('''
+            DELETE FROM image_renditions
+            WHERE image_hash NOT IN (SELECT image_hash FROM product_images)
+        ''')
+        return c.rowcount
+
+    c.execute('SELECT DISTINCT image_hash FROM product_images')
+    referenced = {row[0] for row in c.fetchall()}
+    cutoff = time.time() - min_age
+    removed = 0
+    for root, _, filenames in os.walk(MEDIA_DIR):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if filename.split('-', 1)[0] in referenced or os.path.getmtime(path) > cutoff:
+                continue
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def is_image(image_data):
+    """Cheap header check so obviously bad uploads are refused synchronously."""
+    try:
+        Image.open(BytesIO(image_data))
+    except Exception:
+        return False
+    return True
+
+
+def process_upload(image_data):
+    """Runs in the pool: returns ``(sha, renditions, seconds)``."""
+    started = time.perf_counter()
+    image_sha, renditions = make_renditions(image_data)
+    return image_sha, renditions, time.perf_counter() - started
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # A pool inherited through fork belongs to the parent process
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drop ``pool`` after one of its processes died; the next upload starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def reserve_upload():
+    """Claim a pipeline slot, returns False when the pipeline is full.
+
+    Every successful reservation must be followed by ``submit_upload`` or
+    ``release_upload``.
+    """
+    return _slots.acquire(blocking=False)
+
+
+def release_upload():
+    _slots.release()
+
+
+def submit_upload(image_data, on_done):
+    """Process an upload using a slot claimed with ``reserve_upload``.
+
+    ``on_done(image_sha, renditions)`` is called from a pool thread once the
+    renditions are ready.
+    """
+    submitted = time.perf_counter()
+
+    def finished(future):
+        try:
+            image_sha, renditions, seconds = future.result()
+            on_done(image_sha, renditions)
+        except Exception as e:
+            # E.g. a process OOM-killed while decoding a huge image
+            if isinstance(e, BrokenProcessPool):
+                _discard_pool(pool)
+            metrics.inc('dilivry_image_uploads_total', result='failed')
+            logger.exception("Error processing image")
+            return
+        finally:
+            release_upload()
+
+        elapsed = time.perf_counter() - submitted
+        metrics.inc('dilivry_image_uploads_total', result='ok')
+        metrics.observe('dilivry_image_upload_seconds', elapsed)
+        logger.info("Processed image", extra={
+            'image_hash': image_sha,
+            'process_ms': round(seconds * 1000),
+            'total_ms': round(elapsed * 1000),
+        })
+
+    try:
+        pool = _get_pool()
+        try:
+            future = pool.submit(process_upload, image_data)
+        except BrokenProcessPool:
+            # A process died since the last upload and took the pool with it
+            _discard_pool(pool)
+            pool = _get_pool()
+            future = pool.submit(process_upload, image_data)
+        future.add_done_callback(finished)
+    except Exception:
+        release_upload()
+        raise
@@ -0,0 +1,226 @@
+"""Periodic database maintenance.
+
+Runs in a thread of every gunicorn worker (see gunicorn.conf.py), where a
+file lock picks the one process that does the work, or on its own:
+
+    python maintenance.py           # run tasks as they come due, forever
+    python maintenance.py --once    # run every task now, e.g. from cron
+"""
+import argparse
+import fcntl
+import logging
+import os
+import threading
+import time
+
+import db
+import images
+import shards
+
+# Off when maintenance runs as a separate process instead
+MAINTENANCE_THREAD = os.environ.get('MAINTENANCE_THREAD', '1') != '0'
+MAINTENANCE_LOCK_PATH = os.environ.get('MAINTENANCE_LOCK_PATH', f'{db.DATABASE_PATH}.maintenance.lock')
+TICK_SECONDS = 15
+# Rollup hours rebuilt from orders on each refresh
+ROLLUP_REFRESH_HOURS = 48
+ORPHAN_MIN_AGE_SECONDS = 3600
+# Clients further behind than this get no replay from /orders/<storeId>/events
+ORDER_EVENTS_RETENTION_HOURS = 24
+# Sync tokens older than this get a full resync instead of a delta
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('SYNC_TOMBSTONE_RETENTION_DAYS', 30))
+
+logger = logging.getLogger('dilivry.maintenance')
+
+
+def expire_plans(conn):
+    c = conn.execute('''
+        UPDATE stores
+        SET plan = 'free', plan_updated_at = CURRENT_TIMESTAMP, plan_expires_at = NULL
+        WHERE plan_expires_at <= CURRENT_TIMESTAMP
+    ''')
+    return c.rowcount
+
+
+def checkpoint_wal(conn):
+    # PASSIVE never waits for readers, whatever they still need stays in the WAL
+    _, _, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    return checkpointed
+
+
+def optimize(conn):
+    conn.execute('PRAGMA optimize')
+
+
+def refresh_rollups(conn):
+    """Rebuild recent store_hourly_stats rows from orders.
+
+    The triggers keep the rollups exact; this repairs anything written
+    around them, such as a bulk import with the triggers dropped.
+    """
+    since = conn.execute(
+        "SELECT strftime('%Y-%m-%d %H:00:00', 'now', ?)", (f'-{ROLLUP_REFRESH_HOURS} hours',)
+    ).fetchone()[0]
+    conn.execute('DELETE FROM store_hourly_stats WHERE hour >= ?', (since,))
+    c = conn.execute('''
+        INSERT INTO store_hourly_stats
+            (store_id, hour, orders_count, revenue, pending_count, delivered_count)
+        SELECT store_id, strftime('%Y-%m-%d %H:00:00', created_at), COUNT(*), SUM(total),
+               SUM(status = 'pending'), SUM(delivered = TRUE)
+        FROM orders
+        WHERE created_at >= ?
+        GROUP BY 1, 2
+    ''', (since,))
+    return c.rowcount
+
+
+def prune_order_events(conn):
+    # Ids grow with time, so this only walks the rows it deletes
+    c = conn.execute('''
+        DELETE FROM order_events
+        WHERE id < IFNULL(
+            (SELECT id FROM order_events WHERE created_at >= datetime('now', ?) ORDER BY id LIMIT 1),
+            (SELECT MAX(id) + 1 FROM order_events)
+        )
+    ''', (f'-{ORDER_EVENTS_RETENTION_HOURS} hours',))
+    return c.rowcount
+
+
+def prune_sync_tombstones(conn):
+    # Tokens from before the last pruned tombstone could miss a deletion,
+    # sync.changes() sends them a full copy instead
+    bound = conn.execute('''
+        SELECT IFNULL(
+            (SELECT sync_seq FROM sync_tombstones WHERE deleted_at >= datetime('now', ?) ORDER BY sync_seq LIMIT 1),
+            (SELECT MAX(sync_seq) + 1 FROM sync_tombstones)
+        )
+    ''', (f'-{SYNC_TOMBSTONE_RETENTION_DAYS} days',)).fetchone()[0]
+    last = conn.execute('SELECT MAX(sync_seq) FROM sync_tombstones WHERE sync_seq < ?', (bound,)).fetchone()[0]
+    if last is None:
+        return 0
+    conn.execute('UPDATE sync_clock SET pruned_seq = MAX(pruned_seq, ?)', (last,))
+    c = conn.execute('DELETE FROM sync_tombstones WHERE sync_seq <= ?', (last,))
+    return c.rowcount
+
+
+def cleanup_orphaned_images(conn):
+    return images.remove_orphaned_renditions(conn.cursor(), ORPHAN_MIN_AGE_SECONDS)
+
+
+def on_order_shards(task, main=False):
+    """Run ``task`` on every order shard as well, or only there unless ``main``.
+
+    Without sharding this is ``task`` itself.
+    """
+    if not shards.SHARD_COUNT:
+        return task
+
+    def run(conn):
+        results = [task(conn)] if main else []
+        for path in shards.orders_paths():
+            with db.get_db(path=path) as shard_conn:
+                results.append(task(shard_conn))
+        return results
+    return run
+
+
+# Name, interval in seconds, task
+TASKS = [
+    ('expire_plans', 60, expire_plans),
+    ('checkpoint_wal', 60, on_order_shards(checkpoint_wal, main=True)),
+    ('refresh_rollups', 3600, on_order_shards(refresh_rollups)),
+    ('optimize', 3600, on_order_shards(optimize, main=True)),
+    ('prune_order_events', 3600, on_order_shards(prune_order_events)),
+    ('prune_sync_tombstones', 86400, on_order_shards(prune_sync_tombstones, main=True)),
+    ('cleanup_orphaned_images', 86400, cleanup_orphaned_images),
+]
+
+
+def run_pending(force=False):
+    """Run the tasks that are due, or all of them with ``force``."""
+    with db.get_db() as conn:
+        last_runs = dict(conn.execute('SELECT task, last_run_at FROM maintenance_runs').fetchall())
+
+    for name, interval, task in TASKS:
+        if not force and time.time() - last_runs.get(name, 0) < interval:
+            continue
+
+        started = time.perf_counter()
+        try:
+            with db.get_db() as conn:
+                result = task(conn)
+        except Exception:
+            logger.exception("Maintenance task failed", extra={'task': name})
+            continue
+
+        with db.get_db() as conn:
+            conn.execute('''
+                INSERT INTO maintenance_runs (task, last_run_at) VALUES (?, ?)
+                ON CONFLICT (task) DO UPDATE SET last_run_at = excluded.last_run_at
+            ''', (name, time.time()))
+        logger.info("Maintenance task finished", extra={
+            'task': name,
+            'result': result,
+            'ms': round((time.perf_counter() - started) * 1000),
+        })
+
+
+class LeaderLock:
+    """Non-blocking flock, held for the life of the process once taken."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+
+def run_forever():
+    lock = LeaderLock(MAINTENANCE_LOCK_PATH)
+    while True:
+        # Processes that lost the election keep trying, to take over when the leader exits
+        if lock.acquire():
+            try:
+                run_pending()
+            except Exception:
+                logger.exception("Maintenance run failed")
+        time.sleep(TICK_SECONDS)
+
+
+def start():
+    """Run maintenance in a daemon thread of this process, unless MAINTENANCE_THREAD=0."""
+    if MAINTENANCE_THREAD:
+        threading.Thread(target=run_forever, name='maintenance', daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run database maintenance tasks.")
+    parser.add_argument('--once', action='store_true', help="run every task once and exit")
+    args = parser.parse_args()
+
+    import applog
+    import migrations
+    applog.setup_logging()
+    conn = db.connect()
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrations.migrate(conn)
+    conn.close()
+    shards.init_shards()
+
+    if args.once:
+        run_pending(force=True)
+    else:
+        run_forever()
+
+
+if __name__ == '__main__':
+    main()
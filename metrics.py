@@ -0,0 +1,220 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+import db
+
+# Each worker writes its totals here and /metrics sums them; empty keeps
+# the numbers per process
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 1))
+# Statements whose execute step takes longer than this are logged with
+# their SQL; 0 disables the log
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+FAMILIES = {
+    'dilivry_http_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'dilivry_http_request_duration_seconds': ('histogram', 'Time from request start until the response body was sent.'),
+    'dilivry_http_response_size_bytes': ('histogram', 'Response body size.'),
+    'dilivry_sqlite_duration_seconds': ('histogram', 'Time spent inside SQLite per request.'),
+    'dilivry_sqlite_queries_total': ('counter', 'Statements executed, by endpoint.'),
+    'dilivry_slow_queries_total': ('counter', 'Statements slower than SLOW_QUERY_MS, by endpoint.'),
+    'dilivry_image_uploads_total': ('counter', 'Background image uploads, by result.'),
+    'dilivry_image_upload_seconds': ('histogram', 'Image upload time including the wait for a pool worker.'),
+}
+
+logger = logging.getLogger('dilivry.metrics')
+
+_samples = defaultdict(float)
+_lock = threading.Lock()
+_request = threading.local()
+_worker_file = None
+_flusher_pid = None
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _samples[key] += value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    labels = tuple(sorted(labels.items()))
+    # Buckets are cumulative: the value counts towards every bound above it
+    first = bisect_left(buckets, value)
+    with _lock:
+        for bound in buckets[first:]:
+            _samples[(f'{name}_bucket', labels + (('le', str(bound)),))] += 1
+        _samples[(f'{name}_bucket', labels + (('le', '+Inf'),))] += 1
+        _samples[(f'{name}_sum', labels)] += value
+        _samples[(f'{name}_count', labels)] += 1
+
+
+def _on_query(sql, seconds, executed):
+    if getattr(_request, 'endpoint', None) is None:
+        return
+    _request.queries += executed
+    _request.sqlite_seconds += seconds
+
+    if executed and SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        inc('dilivry_slow_queries_total', endpoint=_request.endpoint)
+        logger.warning("Slow query", extra={'sql': ' '.join(sql.split()), 'ms': round(seconds * 1000, 1)})
+
+
+def _before_request():
+    from flask import request
+
+    _request.started = time.perf_counter()
+    _request.endpoint = request.endpoint or 'unknown'
+    _request.sqlite_seconds = 0.0
+    _request.queries = 0
+    _request.status = 500
+    _request.size = None
+
+
+def _after_request(response):
+    _request.status = response.status_code
+    # Unset for streamed bodies; calculate_content_length() would buffer them
+    _request.size = response.content_length
+    return response
+
+
+def _teardown_request(exc):
+    # Runs once the body has been sent, including streamed responses
+    endpoint = getattr(_request, 'endpoint', None)
+    if endpoint is None:
+        return
+    _request.endpoint = None
+
+    from flask import request
+
+    elapsed = time.perf_counter() - _request.started
+    inc('dilivry_http_requests_total', endpoint=endpoint, method=request.method, status=str(_request.status))
+    observe('dilivry_http_request_duration_seconds', elapsed, endpoint=endpoint)
+    if _request.size is not None:
+        observe('dilivry_http_response_size_bytes', _request.size, SIZE_BUCKETS, endpoint=endpoint)
+    observe('dilivry_sqlite_duration_seconds', _request.sqlite_seconds, endpoint=endpoint)
+    inc('dilivry_sqlite_queries_total', _request.queries, endpoint=endpoint)
+
+    if METRICS_DIR and _flusher_pid != os.getpid():
+        _start_flusher()
+
+
+def init_app(app):
+    """Time every request of ``app`` and the SQLite work done while serving it."""
+    db.on_query = _on_query
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if METRICS_DIR:
+        atexit.register(flush)
+
+
+def _worker_path():
+    global _worker_file
+    # A new name per process start: totals of a previous worker that had
+    # the same pid stay on disk and keep being counted
+    if _worker_file is None or not _worker_file.startswith(f'{os.getpid()}-'):
+        _worker_file = f'{os.getpid()}-{time.time_ns()}.json'
+    return os.path.join(METRICS_DIR, _worker_file)
+
+
+def _start_flusher():
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            flush()
+
+    threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+
+def flush():
+    """Write this worker's totals to METRICS_DIR."""
+    with _lock:
+        samples = [[name, labels, value] for (name, labels), value in _samples.items()]
+    if not samples:
+        return
+
+    path = _worker_path()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(samples, f)
+    os.replace(tmp_path, path)
+
+
+def collect():
+    """Totals of every worker, or of this process when METRICS_DIR is unset."""
+    with _lock:
+        totals = defaultdict(float, _samples)
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return totals
+
+    own_file = os.path.basename(_worker_path())
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.json') or filename == own_file:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                samples = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in samples:
+            totals[(name, tuple(tuple(label) for label in labels))] += value
+    return totals
+
+
+def _family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(item):
+    (name, labels), _ = item
+    # Keep the le buckets of a histogram in numeric order
+    return name, [(key, float(value) if key == 'le' else value) for key, value in labels]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render():
+    """Prometheus text exposition of ``collect()``."""
+    by_family = defaultdict(list)
+    for item in sorted(collect().items(), key=_sort_key):
+        by_family[_family(item[0][0])].append(item)
+
+    lines = []
+    for family, (kind, help_text) in FAMILIES.items():
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        for (name, labels), value in by_family.get(family, ()):
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,636 @@
+import base64
+import json
+import logging
+
+import images
+
+logger = logging.getLogger('dilivry.migrations')
+
+
+def initial_schema(c):
+    """Create the base tables."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            address TEXT NOT NULL,
+            phone_number INTEGER DEFAULT NULL,
+            activity TEXT NOT NULL,
+            code TEXT NOT NULL,
+            plan TEXT DEFAULT 'free' CHECK (plan IN ('free', 'pro')),
+            plan_updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS clients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            store_id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            phone_number VARCHAR(20),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE
+        )
+    ''')
+    # Create products table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            store_id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            description TEXT,
+            price FLOAT NOT NULL,
+            category VARCHAR(50),
+            new INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Create separate images table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS product_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            image_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Create orders table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            store_id INTEGER NOT NULL,
+            client_id INTEGER,
+            name VARCHAR(100) DEFAULT 'aucun',
+            phone_number VARCHAR(20) DEFAULT 'N/A',
+            latitude FLOAT,
+            longitude FLOAT,
+            total FLOAT NOT NULL,
+            products TEXT NOT NULL,
+            status VARCHAR(20) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE,
+            FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE SET NULL
+        )
+    ''')
+
+    # Image bytes, one row per rendition, shared by every product using the same image
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS image_renditions (
+            image_hash TEXT NOT NULL,
+            size TEXT NOT NULL,
+            format TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (image_hash, size, format)
+        )
+    ''')
+
+
+def foreign_key_cleanup(c):
+    """Clear out rows written before foreign keys were enforced."""
+    c.execute('UPDATE orders SET client_id = NULL WHERE client_id NOT IN (SELECT id FROM clients)')
+    c.execute('DELETE FROM product_images WHERE product_id NOT IN (SELECT id FROM products)')
+
+
+def image_renditions(c):
+    """Move base64 product images into image_renditions."""
+    c.execute('PRAGMA table_info(product_images)')
+    if 'image_data' not in [col[1] for col in c.fetchall()]:
+        return False
+
+    c.execute('''
+        CREATE TABLE product_images_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            image_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute('SELECT id, product_id, image_data, created_at FROM product_images')
+    for image_id, product_id, image_data, created_at in c.fetchall():
+        full = base64.b64decode(image_data)
+        image_sha, renditions = images.make_renditions(full, full=full)
+        images.save_renditions(c, image_sha, renditions)
+        c.execute('''
+            INSERT INTO product_images_new (id, product_id, image_hash, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (image_id, product_id, image_sha, created_at))
+    c.execute('DROP TABLE product_images')
+    c.execute('ALTER TABLE product_images_new RENAME TO product_images')
+
+    # The base64 column was most of the file
+    return True
+
+
+def secondary_indexes(c):
+    """Index the columns the routes filter and sort on."""
+    # Merge duplicate clients so the unique index can be built
+    c.execute('''
+        SELECT store_id, phone_number, MIN(id)
+        FROM clients
+        GROUP BY store_id, phone_number
+        HAVING COUNT(*) > 1
+    ''')
+    for store_id, phone_number, keep_id in c.fetchall():
+        c.execute('''
+            UPDATE orders SET client_id = ?
+            WHERE client_id IN (SELECT id FROM clients WHERE store_id = ? AND phone_number = ?)
+        ''', (keep_id, store_id, phone_number))
+        c.execute('''
+            DELETE FROM clients
+            WHERE store_id = ? AND phone_number = ? AND id != ?
+        ''', (store_id, phone_number, keep_id))
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_store_created ON orders (store_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_client ON orders (client_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_store_created ON products (store_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_product_images_product ON product_images (product_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_product_images_hash ON product_images (image_hash)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_store_phone ON clients (store_id, phone_number)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stores_code ON stores (code)')
+    c.execute('ANALYZE')
+
+
+def store_hourly_stats(c):
+    """Keep per-store hourly order rollups for the statistics endpoint."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS store_hourly_stats (
+            store_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            revenue FLOAT NOT NULL DEFAULT 0,
+            pending_count INTEGER NOT NULL DEFAULT 0,
+            delivered_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (store_id, hour)
+        ) WITHOUT ROWID
+    ''')
+
+    c.execute('''
+        INSERT INTO store_hourly_stats
+            (store_id, hour, orders_count, revenue, pending_count, delivered_count)
+        SELECT store_id, strftime('%Y-%m-%d %H:00:00', created_at), COUNT(*), SUM(total),
+               SUM(status = 'pending'), SUM(delivered = TRUE)
+        FROM orders
+        GROUP BY 1, 2
+    ''')
+
+    # Each order counts once, in the bucket of the hour it was created in
+    add_order = '''
+        INSERT INTO store_hourly_stats
+            (store_id, hour, orders_count, revenue, pending_count, delivered_count)
+        VALUES (NEW.store_id, strftime('%Y-%m-%d %H:00:00', NEW.created_at), 1, NEW.total,
+                NEW.status = 'pending', NEW.delivered = TRUE)
+        ON CONFLICT (store_id, hour) DO UPDATE SET
+            orders_count = orders_count + 1,
+            revenue = revenue + excluded.revenue,
+            pending_count = pending_count + excluded.pending_count,
+            delivered_count = delivered_count + excluded.delivered_count;
+    '''
+    remove_order = '''
+        UPDATE store_hourly_stats SET
+            orders_count = orders_count - 1,
+            revenue = revenue - OLD.total,
+            pending_count = pending_count - (OLD.status = 'pending'),
+            delivered_count = delivered_count - (OLD.delivered = TRUE)
+        WHERE store_id = OLD.store_id
+        AND hour = strftime('%Y-%m-%d %H:00:00', OLD.created_at);
+    '''
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_stats_insert AFTER INSERT ON orders
+        BEGIN {add_order} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_stats_update
+        AFTER UPDATE OF store_id, total, status, delivered, created_at ON orders
+        BEGIN {remove_order} {add_order} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_stats_delete AFTER DELETE ON orders
+        BEGIN {remove_order} END
+    ''')
+
+
+def order_items(c):
+    """Normalize order line items out of orders.products."""
+    # product_id is deliberately not a foreign key: sales history must
+    # survive the product being deleted from the catalogue
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            store_id INTEGER NOT NULL,
+            product_id INTEGER,
+            name VARCHAR(100),
+            category VARCHAR(50),
+            qty INTEGER NOT NULL DEFAULT 1,
+            unit_price FLOAT NOT NULL DEFAULT 0,
+            FOREIGN KEY (order_id) REFERENCES orders (id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_order_items_store_product ON order_items (store_id, product_id)')
+
+    c.execute('SELECT id, store_id, products FROM orders')
+    for order_id, store_id, products in c.fetchall():
+        try:
+            items = json.loads(products)
+        except ValueError:
+            continue
+        if not isinstance(items, list):
+            continue
+        c.executemany('''
+            INSERT INTO order_items (order_id, store_id, product_id, name, category, qty, unit_price)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(order_id, store_id) + item for item in line_items(items)])
+
+
+def catalogue_versions(c):
+    """Track a per-store catalogue version for response caching."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS catalogue_versions (
+            store_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # The SELECT finds nothing when a cascading delete already removed the product
+    bump = '''
+        INSERT INTO catalogue_versions (store_id, version)
+        SELECT store_id, 1 FROM {source}
+        ON CONFLICT (store_id) DO UPDATE SET version = version + 1;
+    '''
+    row_store = '(SELECT {row}.store_id AS store_id) WHERE true'
+    product_store = 'products WHERE id = {row}.product_id'
+    triggers = {
+        'trg_products_version_insert': ('AFTER INSERT ON products',
+                                        bump.format(source=row_store.format(row='NEW'))),
+        'trg_products_version_update': ('AFTER UPDATE ON products',
+                                        bump.format(source=row_store.format(row='OLD'))
+                                        + bump.format(source=row_store.format(row='NEW'))),
+        'trg_products_version_delete': ('AFTER DELETE ON products',
+                                        bump.format(source=row_store.format(row='OLD'))),
+        # Images are attached after the product row, by the upload pipeline
+        'trg_product_images_version_insert': ('AFTER INSERT ON product_images',
+                                              bump.format(source=product_store.format(row='NEW'))),
+        'trg_product_images_version_delete': ('AFTER DELETE ON product_images',
+                                              bump.format(source=product_store.format(row='OLD'))),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+
+
+def order_idempotency_keys(c):
+    """Let clients tag orders with an idempotency key so replays are not duplicated."""
+    c.execute('ALTER TABLE orders ADD COLUMN idempotency_key TEXT')
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_store_idempotency
+        ON orders (store_id, idempotency_key)
+        WHERE idempotency_key IS NOT NULL
+    ''')
+
+
+def plan_expiry(c):
+    """Store when a pro plan runs out so expiry can use an index."""
+    c.execute('ALTER TABLE stores ADD COLUMN plan_expires_at TIMESTAMP')
+    c.execute('''
+        UPDATE stores SET plan_expires_at = datetime(plan_updated_at, '+30 days')
+        WHERE plan = 'pro'
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stores_plan_expires
+        ON stores (plan_expires_at)
+        WHERE plan_expires_at IS NOT NULL
+    ''')
+
+
+def maintenance_runs(c):
+    """Record when each maintenance task last ran, shared by all processes."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            task TEXT PRIMARY KEY,
+            last_run_at REAL NOT NULL
+        )
+    ''')
+
+
+def order_locations(c):
+    """Index the positions of undelivered orders in an R*Tree."""
+    # The store is a dimension of its own, so a search never leaves the store
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS orders_geo USING rtree(
+            id, min_store, max_store, min_lat, max_lat, min_lng, max_lng
+        )
+    ''')
+
+    # Orders without coordinates were stored as 0, 0
+    located = '''
+        {row}.delivered = FALSE
+        AND {row}.latitude IS NOT NULL AND {row}.longitude IS NOT NULL
+        AND NOT ({row}.latitude = 0 AND {row}.longitude = 0)
+    '''
+    add_order = '''
+        INSERT INTO orders_geo
+        SELECT NEW.id, NEW.store_id, NEW.store_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+        WHERE {located};
+    '''.format(located=located.format(row='NEW'))
+    remove_order = 'DELETE FROM orders_geo WHERE id = OLD.id;'
+
+    c.execute(f'''
+        INSERT INTO orders_geo
+        SELECT id, store_id, store_id, latitude, latitude, longitude, longitude
+        FROM orders AS NEW
+        WHERE {located.format(row='NEW')}
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_geo_insert AFTER INSERT ON orders
+        BEGIN {add_order} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_geo_update
+        AFTER UPDATE OF store_id, latitude, longitude, delivered ON orders
+        BEGIN {remove_order} {add_order} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_geo_delete AFTER DELETE ON orders
+        BEGIN {remove_order} END
+    ''')
+
+
+def order_events(c):
+    """Log order creation and delivery for the live dashboard feed."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS order_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            store_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_order_events_store ON order_events (store_id, id)')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_event_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO order_events (store_id, order_id, type) VALUES (NEW.store_id, NEW.id, 'created');
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_event_delivered AFTER UPDATE OF delivered ON orders
+        WHEN NEW.delivered AND NOT IFNULL(OLD.delivered, FALSE)
+        BEGIN
+            INSERT INTO order_events (store_id, order_id, type) VALUES (NEW.store_id, NEW.id, 'delivered');
+        END
+    ''')
+
+
+def product_search(c):
+    """Index product names and descriptions for full-text search."""
+    # External content: the index stores tokens only and reads rows back
+    # from products. store_id is indexed as a token so a search can be
+    # narrowed to one store inside the index
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, store_id,
+            content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    c.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+    insert = '''
+        INSERT INTO products_fts (rowid, name, description, store_id)
+        VALUES (NEW.id, NEW.name, NEW.description, NEW.store_id);
+    '''
+    # The 'delete' command needs the values that were indexed
+    delete = '''
+        INSERT INTO products_fts (products_fts, rowid, name, description, store_id)
+        VALUES ('delete', OLD.id, OLD.name, OLD.description, OLD.store_id);
+    '''
+    triggers = {
+        'trg_products_fts_insert': ('AFTER INSERT ON products', insert),
+        'trg_products_fts_update': ('AFTER UPDATE OF name, description, store_id ON products', delete + insert),
+        'trg_products_fts_delete': ('AFTER DELETE ON products', delete),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+
+
+def sync_tracking(c):
+    """Stamp product and order writes and keep deletions, for delta sync."""
+    # One counter per database file; every stamp and tombstone takes the
+    # next value, so "changed since" is a range on an indexed integer.
+    # Timestamps could not serve as the cursor: writes within the same
+    # second, or a clock step back, would be skipped
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_clock (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL,
+            pruned_seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_tombstones (
+            sync_seq INTEGER PRIMARY KEY,
+            store_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sync_tombstones_store
+        ON sync_tombstones (store_id, kind, sync_seq)
+    ''')
+
+    for table in ('products', 'orders'):
+        # ALTER TABLE cannot add a CURRENT_TIMESTAMP default, the insert
+        # triggers below fill these in
+        c.execute(f'ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP')
+        c.execute(f'ALTER TABLE {table} ADD COLUMN sync_seq INTEGER')
+        # Ids grow with time, which is all existing rows need
+        c.execute(f'UPDATE {table} SET updated_at = created_at, sync_seq = id')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_store_sync ON {table} (store_id, sync_seq)')
+    c.execute('''
+        INSERT INTO sync_clock (id, seq)
+        SELECT 1, MAX(IFNULL((SELECT MAX(id) FROM products), 0), IFNULL((SELECT MAX(id) FROM orders), 0))
+    ''')
+
+    tick = 'UPDATE sync_clock SET seq = seq + 1;'
+    # Only sets the two columns, which no other trigger watches; recursive
+    # triggers are off, so it does not fire the update trigger again
+    stamp = '''
+        UPDATE {table} SET updated_at = CURRENT_TIMESTAMP, sync_seq = (SELECT seq FROM sync_clock)
+        WHERE id = {row_id};
+    '''
+    tombstone = '''
+        INSERT INTO sync_tombstones (sync_seq, store_id, kind, row_id)
+        VALUES ((SELECT seq FROM sync_clock), OLD.store_id, '{kind}', OLD.id);
+    '''
+    triggers = {
+        'trg_products_sync_insert': ('AFTER INSERT ON products',
+                                     tick + stamp.format(table='products', row_id='NEW.id')),
+        'trg_products_sync_update': ('AFTER UPDATE OF name, description, price, category, new ON products',
+                                     tick + stamp.format(table='products', row_id='NEW.id')),
+        # Also fired by the cascade when a store is deleted
+        'trg_products_sync_delete': ('AFTER DELETE ON products',
+                                     tick + tombstone.format(kind='product')),
+        # A product's image is part of its synced row
+        'trg_product_images_sync_insert': ('AFTER INSERT ON product_images',
+                                           tick + stamp.format(table='products', row_id='NEW.product_id')),
+        'trg_product_images_sync_delete': ('AFTER DELETE ON product_images',
+                                           tick + stamp.format(table='products', row_id='OLD.product_id')),
+        'trg_orders_sync_insert': ('AFTER INSERT ON orders',
+                                   tick + stamp.format(table='orders', row_id='NEW.id')),
+        'trg_orders_sync_update': ('AFTER UPDATE OF name, phone_number, latitude, longitude, total, products, '
+                                   'status, delivered ON orders',
+                                   tick + stamp.format(table='orders', row_id='NEW.id')),
+        'trg_orders_sync_delete': ('AFTER DELETE ON orders',
+                                   tick + tombstone.format(kind='order')),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+
+
+def database_identity(c):
+    """Give the database a random id, so caches outside it tell copies apart."""
+    c.execute('CREATE TABLE IF NOT EXISTS database_identity (id TEXT NOT NULL)')
+    c.execute("INSERT INTO database_identity (id) VALUES (lower(hex(randomblob(16))))")
+
+
+def order_item_payloads(c):
+    """Keep each line item as sent in order_items and drop orders.products."""
+    c.execute('ALTER TABLE order_items ADD COLUMN item TEXT')
+
+    # Rebuilt from orders.products, so every row gets its item
+    c.execute('DELETE FROM order_items')
+    c.execute('SELECT id, store_id, products FROM orders')
+    for order_id, store_id, products in c.fetchall():
+        try:
+            items = json.loads(products)
+        except ValueError:
+            continue
+        if not isinstance(items, list):
+            continue
+        c.executemany('''
+            INSERT INTO order_items (order_id, store_id, product_id, name, category, qty, unit_price, item)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', order_item_rows(order_id, store_id, items))
+
+    # The sync trigger names the column
+    c.execute('DROP TRIGGER IF EXISTS trg_orders_sync_update')
+    c.execute('ALTER TABLE orders DROP COLUMN products')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_sync_update
+        AFTER UPDATE OF name, phone_number, latitude, longitude, total, status, delivered ON orders
+        BEGIN
+            UPDATE sync_clock SET seq = seq + 1;
+            UPDATE orders SET updated_at = CURRENT_TIMESTAMP, sync_seq = (SELECT seq FROM sync_clock)
+            WHERE id = NEW.id;
+        END
+    ''')
+
+    # The JSON was most of each order row
+    return True
+
+
+def _column_value(value):
+    """``value`` if SQLite can store it as is, otherwise None."""
+    if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+        return None
+    return value if isinstance(value, (str, int, float)) else None
+
+
+def _number(value, default):
+    # Clients send null, strings or nothing at all for these
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return default
+    value = _column_value(value)
+    # NaN would be stored as NULL
+    return default if value is None or isinstance(value, bool) or value != value else value
+
+
+def line_items(products):
+    """``(product_id, name, category, qty, unit_price)`` for each product in an order payload.
+
+    A missing or unusable quantity counts as 1 and price as 0, so one odd
+    item never fails the order or the order_items backfill.
+    """
+    return [(
+        _column_value(item.get('id')),
+        _column_value(item.get('name')),
+        _column_value(item.get('category')),
+        _number(item.get('quantity'), 1),
+        _number(item.get('price'), 0),
+    ) for item in products if isinstance(item, dict)]
+
+
+def order_item_rows(order_id, store_id, products):
+    """order_items rows for an order, each with its item as JSON text."""
+    products = [item for item in products if isinstance(item, dict)]
+    return [
+        (order_id, store_id) + line + (json.dumps(item),)
+        for line, item in zip(line_items(products), products)
+    ]
+
+
+# Applied in order; PRAGMA user_version records how many have run.
+# Only ever append to this list.
+MIGRATIONS = [
+    initial_schema,
+    foreign_key_cleanup,
+    image_renditions,
+    secondary_indexes,
+    store_hourly_stats,
+    order_items,
+    catalogue_versions,
+    order_idempotency_keys,
+    plan_expiry,
+    maintenance_runs,
+    order_locations,
+    order_events,
+    product_search,
+    sync_tracking,
+    database_identity,
+    order_item_payloads,
+]
+
+
+def migrate(conn):
+    """Bring the database up to date, returns the number of migrations applied.
+
+    Safe to call from every worker at startup: an up-to-date database costs
+    a single PRAGMA read, and concurrent callers are serialized by the
+    write lock taken with BEGIN IMMEDIATE.
+    """
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return 0
+
+    vacuum = False
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Another worker may have migrated while we waited for the lock
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        c = conn.cursor()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("Applying migration %d: %s", number, migration.__doc__)
+            vacuum = migration(c) or vacuum
+            c.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    if vacuum:
+        conn.execute('VACUUM')
+    return len(MIGRATIONS) - version
@@ -0,0 +1,236 @@
+"""Data access on SQLAlchemy Core, for the store, client, product and
+delivery routes.
+
+Everything runs on the SQLite files db.get_db() uses; the other routes
+(listing, ingest, statistics, search, routing) still use db.get_db()
+directly. The engine keeps its own pool of up to DB_POOL_SIZE idle
+connections per file next to db.get_db()'s, both opened through
+db.connect().
+
+SQLAlchemy caches the compiled form of every statement here, and sqlite3
+keeps them prepared per connection.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Boolean, Column, Float, ForeignKey, Integer, MetaData, String, Table, Text,
+    create_engine, delete, func, insert, select, update,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import TypeDecorator
+
+import db
+
+# Must name the DATABASE_PATH file, see check_database_url()
+DATABASE_URL = os.environ.get('DATABASE_URL', f'sqlite:///{db.DATABASE_PATH}')
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Timestamp(TypeDecorator):
+    """A timestamp stored as text in the format of SQLite's CURRENT_TIMESTAMP.
+
+    The JSON responses carry that text as it is stored.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return value.strftime(TIMESTAMP_FORMAT)
+        return value
+
+
+# Columns as created by migrations.py; only what the functions below use
+metadata = MetaData()
+
+stores = Table(
+    'stores', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('address', Text, nullable=False),
+    Column('phone_number', Integer),
+    Column('activity', Text, nullable=False),
+    Column('code', Text, nullable=False),
+    Column('plan', Text, server_default='free'),
+    Column('plan_updated_at', Timestamp, server_default=func.current_timestamp()),
+    Column('created_at', Timestamp, server_default=func.current_timestamp()),
+    Column('plan_expires_at', Timestamp),
+)
+
+clients = Table(
+    'clients', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('store_id', Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False),
+    Column('name', String(100), nullable=False),
+    Column('phone_number', String(20)),
+    Column('created_at', Timestamp, server_default=func.current_timestamp()),
+)
+
+products = Table(
+    'products', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('store_id', Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False),
+    Column('name', String(100), nullable=False),
+    Column('description', Text),
+    Column('price', Float, nullable=False),
+    Column('category', String(50)),
+    Column('new', Integer, server_default='0'),
+    Column('created_at', Timestamp, server_default=func.current_timestamp()),
+)
+
+orders = Table(
+    'orders', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('store_id', Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False),
+    Column('delivered', Boolean, server_default='0'),
+)
+
+_engines = {}
+_engines_pid = None
+_engines_lock = threading.Lock()
+
+
+def _create_engine(url):
+    url = make_url(url)
+    # Through db.connect, so pragmas, busy handling and query timing are
+    # the same as for db.get_db() connections
+    return create_engine(
+        url,
+        creator=lambda: db.connect(url.database),
+        poolclass=QueuePool,
+        pool_size=db.DB_POOL_SIZE,
+        # Like db.get_db(): extra connections when busy, closed afterwards
+        max_overflow=-1,
+    )
+
+
+def engine(path=None):
+    """This process's engine for DATABASE_URL, or for the SQLite file at ``path``.
+
+    A forked worker starts its own pools.
+    """
+    global _engines_pid
+    url = f'sqlite:///{path}' if path else DATABASE_URL
+    with _engines_lock:
+        if _engines_pid != os.getpid():
+            # Connections opened before the fork belong to the parent
+            for inherited in _engines.values():
+                inherited.dispose(close=False)
+            _engines_pid = os.getpid()
+        if url not in _engines:
+            _engines[url] = _create_engine(url)
+        return _engines[url]
+
+
+@contextmanager
+def transaction(path=None):
+    """A connection in a transaction, committed when the block exits normally.
+
+    ``path`` selects an SQLite file other than DATABASE_URL, such as an
+    order shard.
+    """
+    with engine(path).begin() as conn:
+        yield conn
+
+
+def check_database_url():
+    """Raise unless DATABASE_URL is the SQLite file at DATABASE_PATH.
+
+    Orders, products and statistics are read through db.get_db(), so any
+    other database would split stores and clients off from them.
+    """
+    url = make_url(DATABASE_URL)
+    if (url.get_backend_name() != 'sqlite' or not url.database
+            or os.path.realpath(url.database) != os.path.realpath(db.DATABASE_PATH)):
+        raise RuntimeError(
+            f"DATABASE_URL must name the DATABASE_PATH file ({db.DATABASE_PATH}), "
+            "the routes on db.get_db() read that file"
+        )
+
+
+def utcnow():
+    # Naive UTC, like CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def create_store(conn, name, address, phone_number, activity, code):
+    result = conn.execute(insert(stores).values(
+        name=name, address=address, phone_number=phone_number, activity=activity, code=code
+    ))
+    return result.inserted_primary_key[0]
+
+
+def get_store(conn, store_id):
+    row = conn.execute(select(stores).where(stores.c.id == store_id)).mappings().first()
+    return dict(row) if row else None
+
+
+def list_stores(conn):
+    """Every store, without the login code."""
+    columns = [column for column in stores.c if column.name != 'code']
+    return [dict(row) for row in conn.execute(select(*columns)).mappings()]
+
+
+def set_plan(conn, code, plan, expires_at):
+    conn.execute(
+        update(stores)
+        .where(stores.c.code == code)
+        .values(plan=plan, plan_updated_at=func.current_timestamp(), plan_expires_at=expires_at)
+    )
+
+
+def get_or_create_client(conn, store_id, name, phone_number):
+    """``(client_id, created)`` of the store's client with ``phone_number``."""
+    client_id = conn.execute(
+        select(clients.c.id).where(clients.c.phone_number == phone_number, clients.c.store_id == store_id)
+    ).scalar()
+    if client_id is not None:
+        return client_id, False
+    result = conn.execute(insert(clients).values(name=name, phone_number=phone_number, store_id=store_id))
+    return result.inserted_primary_key[0], True
+
+
+def delete_product(conn, product_id, store_id=None):
+    """Delete a product, only from ``store_id`` when given; returns whether one was deleted."""
+    statement = delete(products).where(products.c.id == product_id)
+    if store_id is not None:
+        statement = statement.where(products.c.store_id == store_id)
+    return conn.execute(statement).rowcount > 0
+
+
+def confirm_delivery(conn, order_id, store_id=None):
+    """Mark an order delivered.
+
+    Returns True when this call delivered it, False when it already was
+    and None when there is no such order (in ``store_id``, when given).
+    """
+    return confirm_deliveries(conn, [order_id], store_id).get(order_id)
+
+
+def confirm_deliveries(conn, order_ids, store_id=None):
+    """Mark orders delivered, returns ``{order_id: delivered by this call}`` for the ones that exist.
+
+    Only orders of ``store_id`` when given. Orders already delivered are
+    left alone, so their rows, triggers and sync stamps are not written
+    again.
+    """
+    conditions = [orders.c.id.in_(order_ids)]
+    if store_id is not None:
+        conditions.append(orders.c.store_id == store_id)
+    confirmed = conn.execute(
+        update(orders)
+        .where(*conditions, orders.c.delivered.is_not(True))
+        .values(delivered=True)
+        .returning(orders.c.id)
+    ).scalars().all()
+    found = dict.fromkeys(confirmed, True)
+    if len(found) < len(set(order_ids)):
+        conditions[0] = orders.c.id.in_([order_id for order_id in order_ids if order_id not in found])
+        found.update(dict.fromkeys(conn.execute(select(orders.c.id).where(*conditions)).scalars(), False))
+    return found
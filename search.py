@@ -0,0 +1,84 @@
+import re
+
+# bm25() weights of the products_fts columns: a word in the name counts
+# more than one in the description, the store token does not count
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+MAX_QUERY_TERMS = 8
+
+SEARCH_PRODUCT_FIELDS = ['id', 'name', 'description', 'price', 'category', 'new', 'created_at']
+
+
+def match_expression(store_id, text):
+    """FTS5 query for a store's products matching every word of ``text``.
+
+    Each word is quoted, so operators and punctuation typed by customers are
+    taken literally, and matched as a prefix so results show up while the
+    word is still being typed. None when ``text`` has no words.
+    """
+    terms = re.findall(r'\w+', text)[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    words = ' '.join(f'"{term}"*' for term in terms)
+    return f'store_id : "{int(store_id)}" AND ({words})'
+
+
+def search_products(conn, store_id, text=None, category=None, new=None, limit=20, offset=0):
+    """A page of a store's products, best matches first, with category facets.
+
+    Returns ``(products, total, facets)``. ``facets`` counts the matches per
+    category before the ``category`` filter is applied, so a client can show
+    how many results each category would give. Without ``text`` products
+    are listed newest first.
+    """
+    if text:
+        expression = match_expression(store_id, text)
+        if expression is None:
+            return [], 0, []
+        # CROSS JOIN keeps the index as the outer loop; left to itself the
+        # planner may scan products and probe the index once per row
+        source = 'products_fts f CROSS JOIN products p ON p.id = f.rowid'
+        conditions = ['products_fts MATCH ?']
+        params = [expression]
+        order = f'bm25(products_fts, {NAME_WEIGHT}, {DESCRIPTION_WEIGHT}, 0.0), p.id DESC'
+    else:
+        source = 'products p'
+        conditions = ['p.store_id = ?']
+        params = [store_id]
+        order = 'p.created_at DESC, p.id DESC'
+
+    if new is not None:
+        conditions.append('p.new = 1' if new else 'IFNULL(p.new, 0) = 0')
+
+    c = conn.cursor()
+    c.row_factory = None
+    c.execute(f'''
+        SELECT p.category, COUNT(*) FROM {source}
+        WHERE {' AND '.join(conditions)}
+        GROUP BY p.category
+        ORDER BY COUNT(*) DESC, p.category
+    ''', params)
+    facets = [{"category": category_name, "count": count} for category_name, count in c.fetchall()]
+
+    if category is not None:
+        conditions.append('p.category = ?')
+        params.append(category)
+        total = sum(facet['count'] for facet in facets if facet['category'] == category)
+    else:
+        total = sum(facet['count'] for facet in facets)
+
+    products = []
+    if total > offset:
+        c.execute(f'''
+            SELECT {', '.join('p.' + field for field in SEARCH_PRODUCT_FIELDS)},
+                   (SELECT image_hash FROM product_images WHERE product_id = p.id ORDER BY id DESC LIMIT 1)
+            FROM {source}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        ''', params + [limit, offset])
+        for row in c.fetchall():
+            product = dict(zip(SEARCH_PRODUCT_FIELDS, row))
+            product['image_hash'] = row[-1]
+            products.append(product)
+    return products, total, facets
@@ -0,0 +1,223 @@
+"""Optional sharding of order data by store.
+
+With SHARD_COUNT set, the orders of store ``s`` and everything derived
+from them (order_items, order_events, store_hourly_stats, orders_geo) live
+in shard file ``s % SHARD_COUNT`` instead of DATABASE_PATH, so stores in
+different shards never wait for each other's write lock. Stores, clients
+and catalogues stay in DATABASE_PATH.
+
+Switching an existing database over:
+
+    SHARD_COUNT=8 python shards.py split    # copies order data into the shards
+"""
+import argparse
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import migrations
+
+# 0 keeps every table in DATABASE_PATH
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 0))
+SHARD_PATH_TEMPLATE = os.environ.get(
+    'SHARD_PATH_TEMPLATE', os.path.splitext(db.DATABASE_PATH)[0] + '.shard{}.db'
+)
+# New orders of shard k get ids from k * ORDER_ID_SPAN, so the id of an
+# order is enough to find its shard
+ORDER_ID_SPAN = 1 << 40
+
+# Tables split by store_id; the rest of a shard's schema stays empty
+ORDER_TABLES = ('orders', 'order_items', 'order_events', 'store_hourly_stats')
+MAIN_TABLES = ('products', 'product_images', 'image_renditions', 'catalogue_versions', 'clients', 'stores')
+
+logger = logging.getLogger('dilivry.shards')
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def shard_path(index):
+    return SHARD_PATH_TEMPLATE.format(index)
+
+
+def orders_paths():
+    """Every database holding orders."""
+    if not SHARD_COUNT:
+        return [db.DATABASE_PATH]
+    return [shard_path(index) for index in range(SHARD_COUNT)]
+
+
+# Orders reference stores and clients, which are in another file
+for _path in orders_paths() if SHARD_COUNT else []:
+    db.PATH_PRAGMAS[_path] = ('PRAGMA foreign_keys = OFF',)
+
+
+def orders_path(store_id):
+    """The database holding the orders of ``store_id``."""
+    if not SHARD_COUNT:
+        return db.DATABASE_PATH
+    return shard_path(int(store_id) % SHARD_COUNT)
+
+
+def orders_db(store_id, row_factory=None, immediate=False):
+    """``db.get_db()`` on the database holding the orders of ``store_id``."""
+    return db.get_db(row_factory, orders_path(store_id), immediate)
+
+
+def order_path(order_id):
+    """The shard holding order ``order_id``.
+
+    None without sharding, where orders are in the main database, and
+    when no shard has the order.
+    """
+    if not SHARD_COUNT:
+        return None
+    if order_id >= ORDER_ID_SPAN:
+        index = order_id // ORDER_ID_SPAN
+        return shard_path(index) if index < SHARD_COUNT else None
+
+    # Below the span are orders copied over by split() and new orders of
+    # shard 0; the primary key lookup is cheap enough to try every shard
+    for path in orders_paths():
+        with db.get_db(path=path) as conn:
+            if conn.execute('SELECT 1 FROM orders WHERE id = ?', (order_id,)).fetchone():
+                return path
+    return None
+
+
+def group_orders(order_ids, store_id=None):
+    """``{path: [order_id, ...]}`` of the shards that may hold each order.
+
+    Orders whose shard is not known from their id (see order_path) are
+    listed under every shard, unless they belong to ``store_id``, whose
+    orders are all in one. The path is None without sharding.
+    """
+    if not SHARD_COUNT:
+        return {None: list(order_ids)}
+    if store_id is not None:
+        return {orders_path(store_id): list(order_ids)}
+    groups = {path: [] for path in orders_paths()}
+    for order_id in order_ids:
+        if order_id < ORDER_ID_SPAN:
+            for ids in groups.values():
+                ids.append(order_id)
+        elif order_id // ORDER_ID_SPAN < SHARD_COUNT:
+            groups[shard_path(order_id // ORDER_ID_SPAN)].append(order_id)
+    return {path: ids for path, ids in groups.items() if ids}
+
+
+def scatter(func):
+    """``func(path)`` for every database holding orders, run in parallel.
+
+    Results come back in shard order.
+    """
+    global _executor, _executor_pid
+    paths = orders_paths()
+    if len(paths) == 1:
+        return [func(paths[0])]
+    with _executor_lock:
+        # Pool threads do not survive a fork
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix='shards')
+            _executor_pid = os.getpid()
+    return list(_executor.map(func, paths))
+
+
+def _reserve_ids(conn, index):
+    floor = index * ORDER_ID_SPAN
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'orders'").fetchone()
+    if row is None:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('orders', ?)", (floor,))
+    elif row[0] < floor:
+        conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'orders'", (floor,))
+    conn.commit()
+
+
+def init_shards():
+    """Create missing shard files and bring their schema up to date.
+
+    Refuses to create them while DATABASE_PATH still holds orders: those
+    have to be moved over with ``shards.py split`` first, or they would no
+    longer be read.
+    """
+    missing = [path for path in orders_paths() if not os.path.exists(path)]
+    if missing:
+        conn = db.connect(db.DATABASE_PATH)
+        try:
+            has_orders = conn.execute('SELECT EXISTS (SELECT 1 FROM orders)').fetchone()[0]
+        finally:
+            conn.close()
+        if has_orders:
+            raise RuntimeError(
+                f"Shard files are missing ({', '.join(missing)}) and {db.DATABASE_PATH} "
+                f"has orders; run 'SHARD_COUNT={SHARD_COUNT} python shards.py split' first"
+            )
+
+    for index in range(SHARD_COUNT):
+        conn = db.connect(shard_path(index))
+        conn.execute('PRAGMA busy_timeout = 60000')
+        conn.execute('PRAGMA journal_mode = WAL')
+        migrations.migrate(conn)
+        _reserve_ids(conn, index)
+        conn.close()
+
+
+def split(source):
+    """Copy the order data of ``source`` into new shard files.
+
+    Each shard starts as a copy of the whole database, then drops the
+    orders of stores in other shards and the tables that stay in the main
+    database. ``source`` is left untouched; its order tables are no longer
+    read once SHARD_COUNT is set.
+    """
+    existing = [path for path in orders_paths() if os.path.exists(path)]
+    if existing:
+        raise SystemExit(f"Shard files already exist: {', '.join(existing)}")
+
+    conn = db.connect(source)
+    try:
+        for index in range(SHARD_COUNT):
+            path = shard_path(index)
+            conn.execute('VACUUM INTO ?', (path,))
+
+            shard = db.connect(path)
+            # Orders first, their triggers clean up orders_geo
+            for table in ORDER_TABLES:
+                shard.execute(f'DELETE FROM {table} WHERE store_id % ? != ?', (SHARD_COUNT, index))
+            for table in MAIN_TABLES:
+                shard.execute(f'DELETE FROM {table}')
+            # Rows moved elsewhere are not deletions for sync clients
+            shard.execute('DELETE FROM sync_tombstones')
+            shard.commit()
+            shard.execute('VACUUM')
+            shard.execute('PRAGMA journal_mode = WAL')
+            _reserve_ids(shard, index)
+            orders = shard.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+            shard.close()
+            logger.info("Shard written", extra={'path': path, 'orders': orders})
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the order shards, see SHARD_COUNT.")
+    parser.add_argument('command', choices=['split'])
+    parser.add_argument('--source', default=db.DATABASE_PATH, help="database to split")
+    args = parser.parse_args()
+    if not SHARD_COUNT:
+        parser.error("set SHARD_COUNT to the number of shards")
+
+    import applog
+    applog.setup_logging()
+    conn = db.connect(args.source)
+    migrations.migrate(conn)
+    conn.close()
+
+    split(args.source)
+
+
+if __name__ == '__main__':
+    main()